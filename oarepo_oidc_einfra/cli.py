@@ -7,33 +7,30 @@
 #
 """EInfra terminal commands."""
 
-import json
+from __future__ import annotations
+
 import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import UTC, datetime
-from io import BytesIO
 from typing import TYPE_CHECKING
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
-from invenio_access.permissions import system_identity
-from invenio_accounts.models import User, UserIdentity
-from invenio_communities.communities.records.models import CommunityMetadata
-from invenio_communities.members.records.models import MemberModel
-from invenio_communities.proxies import current_communities
 from invenio_db import db
-from werkzeug.local import LocalProxy
+from sqlalchemy import select
 
 from oarepo_oidc_einfra.mutex import CacheMutex
 from oarepo_oidc_einfra.proxies import current_einfra_oidc
-from oarepo_oidc_einfra.resources import store_dump
-from oarepo_oidc_einfra.tasks import (
-    create_aai_invitation,
-    synchronize_community_to_perun,
-    update_from_perun_dump,
-)
+
+# Note: heavy imports (invenio_communities, invenio_accounts, tasks, resources -> boto3)
+# are made inside the commands so that they are not paid on every "flask" invocation
 
 if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from uuid import UUID
+
+    from flask import Flask
     from flask_security.datastore import UserDatastore
 
 
@@ -50,12 +47,16 @@ def upload_dump(dump_file: str) -> None:
 
     :param dump_file: Path to the dump file on the local filesystem to import.
     """
+    from oarepo_oidc_einfra.resources import store_dump
+    from oarepo_oidc_einfra.tasks import update_from_perun_dump
+
     click.echo(f"Importing dump file {dump_file}")
 
     with open(dump_file, "rb") as f:
-        path, checksum = store_dump(f.read())
+        path, checksum = store_dump(f)
 
-    update_from_perun_dump.delay(path, checksum)
+    result = update_from_perun_dump.delay(path, checksum)
+    click.echo(f"Dump stored as {path}, processing scheduled as task {result.id}")
 
 
 @einfra.command("update_from_dump")
@@ -76,6 +77,8 @@ def update_from_dump(
     :param on_background: Whether to run the task in the background.
     :param fix_communities_in_perun: Whether to fix communities in Perun.
     """
+    from oarepo_oidc_einfra.tasks import update_from_perun_dump
+
     # set python logger to show info from PerunSynchronizationTask
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("PerunSynchronizationTask")
@@ -109,11 +112,23 @@ def clear_import_mutex() -> None:
     CacheMutex("EINFRA_SYNC_MUTEX").force_clear()
 
 
-def _add_einfra_user(email: str, einfra_id: str) -> None:
-    """Add a user to the system if it does not exist and link it with the EInfra identity."""
-    _datastore: UserDatastore = LocalProxy(  # type: ignore
-        lambda: current_app.extensions["security"].datastore
-    )
+def _get_datastore() -> UserDatastore:
+    """Return the user datastore of the current application."""
+    return current_app.extensions["security"].datastore
+
+
+def _add_einfra_user(
+    email: str, einfra_id: str, datastore: UserDatastore | None = None
+) -> None:
+    """Add a user to the system if it does not exist and link it with the EInfra identity.
+
+    :param email:       email of the user
+    :param einfra_id:   einfra id of the user
+    :param datastore:   user datastore, if not passed it is taken from the current app
+    """
+    from invenio_accounts.models import User, UserIdentity
+
+    datastore = datastore or _get_datastore()
 
     email = email.lower()
     user = User.query.filter_by(email=email).first()
@@ -124,14 +139,11 @@ def _add_einfra_user(email: str, einfra_id: str) -> None:
             "active": True,
             "confirmed_at": datetime.now(UTC),
         }
-        _datastore.create_user(**kwargs)
+        user = datastore.create_user(**kwargs)
         db.session.commit()  # type: ignore
 
-        user = User.query.filter_by(email=email).one()
-
-    identity = UserIdentity.query.filter_by(
-        method="e-infra", id=einfra_id, id_user=user.id
-    ).first()
+    # (method, id) is the primary key of the identity
+    identity = UserIdentity.query.filter_by(method="e-infra", id=einfra_id).first()
     if not identity:
         UserIdentity.create(
             user=user,
@@ -141,28 +153,72 @@ def _add_einfra_user(email: str, einfra_id: str) -> None:
         db.session.commit()  # type: ignore
 
 
-@einfra.command("import_dump_users")
-@click.argument("dump_path")
-@with_appcontext
-def import_dump_users(dump_path: str) -> None:
-    """Import users from a dump file.
+def _bulk_add_einfra_users(
+    users: Iterable[tuple[str, str]], datastore: UserDatastore | None = None
+) -> None:
+    """Add users to the system if they do not exist and link them with their EInfra identities.
 
-    :param dump_path: Path to the dump file in the S3 bucket.
+    Existing users and identities are fetched in two queries, only the missing ones are created
+    and everything is committed at once.
 
-    Note: this cli command is usually not used in the application, it is here for testing purposes.
+    :param users:       iterable of (email, einfra_id) pairs
+    :param datastore:   user datastore, if not passed it is taken from the current app
     """
-    client = current_einfra_oidc.dump_boto3_client
-
-    with BytesIO() as obj:
-        client.download_fileobj(
-            Bucket=current_einfra_oidc.dump_s3_bucket,
-            Key=dump_path,
-            Fileobj=obj,
+    from invenio_accounts.models import User, UserIdentity
+
+    datastore = datastore or _get_datastore()
+
+    einfra_id_to_email = {einfra_id: email.lower() for email, einfra_id in users}
+    if not einfra_id_to_email:
+        return
+
+    users_by_email = {
+        user.email: user
+        for user in User.query.filter(User.email.in_(set(einfra_id_to_email.values())))
+    }
+    linked_einfra_ids = {
+        row[0]
+        for row in db.session.query(UserIdentity.id).filter(  # type: ignore
+            UserIdentity.method == "e-infra",
+            UserIdentity.id.in_(einfra_id_to_email.keys()),
+        )
+    }
+
+    for email in set(einfra_id_to_email.values()) - users_by_email.keys():
+        users_by_email[email] = datastore.create_user(
+            email=email,
+            password=None,
+            active=True,
+            confirmed_at=datetime.now(UTC),
         )
-        obj.seek(0)
-        data = json.loads(obj.getvalue().decode("utf-8"))
+    # assign ids to the newly created users
+    db.session.flush()  # type: ignore
+
+    db.session.bulk_insert_mappings(  # type: ignore
+        UserIdentity,
+        [
+            {
+                "id": einfra_id,
+                "method": "e-infra",
+                "id_user": users_by_email[email].id,
+            }
+            for einfra_id, email in einfra_id_to_email.items()
+            if einfra_id not in linked_einfra_ids
+        ],
+    )
+    db.session.commit()  # type: ignore
+
+
+def _dump_einfra_users(dump_stream: Iterable[bytes]) -> Iterable[tuple[str, str]]:
+    """Parse (email, einfra_id) pairs of users from a dump stream.
 
-    for user_data in data["users"].values():
+    Users without an email or einfra id are skipped.
+
+    :param dump_stream:     binary stream with the dump
+    """
+    import ijson
+
+    for _user_id, user_data in ijson.kvitems(dump_stream, "users"):
         einfra_id = user_data["attributes"].get(
             "urn:perun:user:attribute-def:virt:login-namespace:einfraid-persistent"
         )
@@ -171,8 +227,77 @@ def import_dump_users(dump_path: str) -> None:
         )
         if not email or not einfra_id:
             continue
-        print("Importing user", email, einfra_id)
-        _add_einfra_user(email, einfra_id)
+        yield email, einfra_id
+
+
+def _import_user_batch(app: Flask, users: list[tuple[str, str]]) -> None:
+    """Import a batch of users inside a worker thread.
+
+    If another worker has concurrently created some of the users (for example when two
+    perun users share the same email), the batch is rolled back and imported again,
+    this time seeing the rows committed by the other worker.
+
+    :param app:     flask application
+    :param users:   list of (email, einfra_id) pairs
+    """
+    from sqlalchemy.exc import IntegrityError
+
+    with app.app_context():
+        try:
+            _bulk_add_einfra_users(users)
+        except IntegrityError:
+            db.session.rollback()  # type: ignore
+            _bulk_add_einfra_users(users)
+
+
+@einfra.command("import_dump_users")
+@click.argument("dump_path")
+@click.option("--workers", default=1, help="Number of threads importing the users.")
+@with_appcontext
+def import_dump_users(dump_path: str, workers: int) -> None:
+    """Import users from a dump file.
+
+    :param dump_path: Path to the dump file in the S3 bucket.
+    :param workers: Number of threads importing batches of users in parallel.
+
+    Note: this cli command is usually not used in the application, it is here for testing purposes.
+    """
+    from tqdm import tqdm
+
+    from oarepo_oidc_einfra.tasks import chunks
+
+    client = current_einfra_oidc.dump_boto3_client
+
+    # stream the dump from s3 and parse users one by one, so that the whole dump
+    # is never held in memory
+    body = client.get_object(
+        Bucket=current_einfra_oidc.dump_s3_bucket,
+        Key=dump_path,
+    )["Body"]
+
+    user_batches = chunks(
+        tqdm(_dump_einfra_users(body), mininterval=1.0, smoothing=0.1, unit="user"),
+        1000,
+    )
+
+    if workers <= 1:
+        datastore = _get_datastore()
+        for user_batch in user_batches:
+            _bulk_add_einfra_users(user_batch, datastore)
+        return
+
+    app = current_app._get_current_object()  # type: ignore
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # keep only a bounded number of batches in flight so that the dump is still streamed
+        pending: set[Future] = set()
+        for user_batch in user_batches:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(_import_user_batch, app, list(user_batch)))
+        for future in pending:
+            future.result()
 
 
 @einfra.command("synchronize_community")
@@ -180,19 +305,46 @@ def import_dump_users(dump_path: str) -> None:
 @with_appcontext
 def synchronize_community(community_slug: str) -> None:
     """Re-synchronize a community to Perun."""
+    from invenio_access.permissions import system_identity
+    from invenio_communities.proxies import current_communities
+
+    from oarepo_oidc_einfra.tasks import synchronize_community_to_perun
+
     community = current_communities.service.read(system_identity, community_slug)
     synchronize_community_to_perun(str(community.id))
 
 
 @einfra.command("synchronize_all_communities")
+@click.option("--on-background/--on-foreground", default=False)
+@click.option("--skip-unchanged/--all", default=False)
 @with_appcontext
-def synchronize_all_communities() -> None:
-    """Re-synchronize all communities to Perun."""
+def synchronize_all_communities(on_background: bool, skip_unchanged: bool) -> None:
+    """Re-synchronize all communities to Perun.
+
+    :param on_background: Whether to run the synchronization as a background task.
+    :param skip_unchanged: Skip communities that have not changed since their last synchronization.
+    """
+    from invenio_communities.communities.records.models import CommunityMetadata
     from tqdm import tqdm
 
-    community_list = CommunityMetadata.query.all()
-    for community in tqdm(community_list):
-        synchronize_community_to_perun(str(community.id))
+    from oarepo_oidc_einfra.tasks import (
+        synchronize_all_communities_to_perun,
+        synchronize_community_to_perun,
+    )
+
+    if on_background:
+        result = synchronize_all_communities_to_perun.delay(
+            skip_unchanged=skip_unchanged
+        )
+        click.echo(f"Synchronization scheduled as task {result.id}")
+        return
+
+    # fetch all the ids first, so that no cursor is kept open while talking to perun
+    community_ids = (
+        db.session.execute(select(CommunityMetadata.id)).scalars().all()  # type: ignore
+    )
+    for community_id in tqdm(community_ids):
+        synchronize_community_to_perun(str(community_id), skip_unchanged=skip_unchanged)
 
 
 @einfra.command("resend_invitation")
@@ -205,10 +357,47 @@ def resend_invitation(community_slug: str, email: str) -> None:
     :param community_slug: Slug of the community.
     :param email: Email of the user.
     """
-    community = CommunityMetadata.query.filter_by(slug=community_slug).one()
-    user = User.query.filter_by(email=email).one()
-    member = MemberModel.query.filter_by(
-        user_id=user.id, community_id=community.id
-    ).one()
-    request_id = member.request_id
+    from invenio_communities.members.records.models import MemberModel
+
+    from oarepo_oidc_einfra.tasks import create_aai_invitation
+
+    (request_id,) = (
+        MemberModel.query.with_entities(MemberModel.request_id)
+        .filter_by(
+            user_id=_user_id_for_email(email),
+            community_id=_community_id_for_slug(community_slug),
+        )
+        .one()
+    )
     create_aai_invitation(str(request_id))
+
+
+# Note: the id lookups below are intentionally not cached (functools.lru_cache) - every
+# command does a single lookup, and a module-global cache would keep returning stale ids
+# when the app is reused (long-lived shell, tests) after a community or user is recreated.
+
+
+def _community_id_for_slug(slug: str) -> UUID:
+    """Return the id of the community with the given slug.
+
+    :param slug: Slug of the community.
+    """
+    from invenio_communities.communities.records.models import CommunityMetadata
+
+    (community_id,) = (
+        CommunityMetadata.query.with_entities(CommunityMetadata.id)
+        .filter_by(slug=slug)
+        .one()
+    )
+    return community_id
+
+
+def _user_id_for_email(email: str) -> int:
+    """Return the id of the user with the given email.
+
+    :param email: Email of the user.
+    """
+    from invenio_accounts.models import User
+
+    (user_id,) = User.query.with_entities(User.id).filter_by(email=email).one()
+    return user_id
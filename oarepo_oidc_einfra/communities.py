@@ -11,8 +11,12 @@ from __future__ import annotations
 
 import dataclasses
 import logging
+import time
+from collections import defaultdict
 from functools import cached_property
-from typing import TYPE_CHECKING, Iterable
+from operator import itemgetter
+from typing import TYPE_CHECKING, Any
+from weakref import WeakKeyDictionary
 
 from flask import current_app
 from invenio_access.permissions import system_identity
@@ -21,19 +25,25 @@ from invenio_communities.members.errors import AlreadyMemberError
 from invenio_communities.members.records.models import MemberModel
 from invenio_communities.proxies import current_communities
 from invenio_db import db
+from invenio_records_resources.services.uow import UnitOfWork
 from marshmallow import ValidationError
-from sqlalchemy import select
+from sqlalchemy import event, select
 from sqlalchemy.sql.expression import true
 
 if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
     from uuid import UUID
 
+    from flask import Flask
     from invenio_accounts.models import User
 
 log = logging.getLogger(__name__)
 
+MEMBERSHIP_QUERY_CHUNK_SIZE = 10_000
+"""Maximum number of user ids passed to a single membership query."""
 
-@dataclasses.dataclass(frozen=True)
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class CommunityRole:
     """A class representing a community and a role."""
 
@@ -41,40 +51,120 @@ class CommunityRole:
     role: str
 
 
-class CommunitySupport:
-    """A support class for working with communities and their members."""
+_community_cache: WeakKeyDictionary[Flask, dict[str, tuple[float, Any]]] = (
+    WeakKeyDictionary()
+)
+"""Process-wide cache of community data, app -> name -> (timestamp, value).
 
-    @cached_property
-    def slug_to_id(self) -> dict[str, UUID]:
-        """Returns a mapping of community slugs to their ids."""
+Keyed by the application object itself (weakly), so that the entries of an application
+are dropped together with it and can never be picked up by another application.
+"""
+
+
+def _cached_community_data(
+    name: str,
+    factory: Callable[[], Any],
+    refresh: bool = False,
+) -> Any:  # noqa: ANN401
+    """Return a cached value, computing it by the factory if it is missing or expired.
+
+    The cache is cleared whenever a community is created, updated or deleted in this process.
+    Changes made in other processes are picked up after EINFRA_COMMUNITY_CACHE_TIMEOUT seconds.
+
+    :param name:        name of the cached value
+    :param factory:     function that computes the value
+    :param refresh:     always compute the value (and store it in the cache)
+    """
+    app_cache = _community_cache.setdefault(current_app._get_current_object(), {})  # type: ignore
+    now = time.monotonic()
+    entry = app_cache.get(name)
+    if (
+        refresh
+        or entry is None
+        or now - entry[0] > current_app.config["EINFRA_COMMUNITY_CACHE_TIMEOUT"]
+    ):
+        entry = (now, factory())
+        app_cache[name] = entry
+    return entry[1]
+
+
+def clear_community_cache(*args: Any, **kwargs: Any) -> None:  # noqa: ANN401
+    """Clear the cached community data.
+
+    Signature allows this function to be used directly as a sqlalchemy event listener.
+    """
+    _community_cache.clear()
+
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    event.listen(Community.model_cls, _event_name, clear_community_cache)
+
+
+def get_slug_to_id(refresh: bool = False) -> dict[str, UUID]:
+    """Return a (cached) mapping of community slugs to their ids.
+
+    :param refresh:     load the mapping from the database, bypassing the cache
+    """
+
+    def load() -> dict[str, UUID]:
         return {
-            row[1]: row[0]
+            row["slug"]: row["id"]
             for row in db.session.execute(  # type: ignore
                 select(Community.model_cls.id, Community.model_cls.slug)
-            )
+            ).mappings()
         }
 
-    @cached_property
-    def all_community_roles(self) -> set[CommunityRole]:
+    return _cached_community_data("slug_to_id", load, refresh)
+
+
+def get_all_community_roles(refresh: bool = False) -> frozenset[CommunityRole]:
+    """Return a (cached) set of all community roles (pair of community id, role name) known to the repository.
+
+    :param refresh:     load the roles from the database, bypassing the cache
+    """
+
+    def load() -> frozenset[CommunityRole]:
+        community_roles = CommunitySupport().role_names
+
+        # only ids are needed, so do not construct the ORM community objects
+        community_ids = (
+            db.session.execute(select(Community.model_cls.id)).scalars().all()  # type: ignore
+        )
+        # immutable, as the value is shared by all callers
+        return frozenset(
+            CommunityRole(community_id, role)
+            for community_id in community_ids
+            for role in community_roles
+        )
+
+    return _cached_community_data("all_community_roles", load, refresh)
+
+
+class CommunitySupport:
+    """A support class for working with communities and their members."""
+
+    @property
+    def slug_to_id(self) -> dict[str, UUID]:
+        """Returns a mapping of community slugs to their ids."""
+        return get_slug_to_id()
+
+    @property
+    def all_community_roles(self) -> frozenset[CommunityRole]:
         """Return a set of all community roles (pair of community id, role name) known to the repository.
 
         :return:                    a set of all community roles known to the repository
         """
-        repository_comunity_roles = set()
-        community_roles = self.role_names
-
-        for community in Community.model_cls.query.all():
-            for role in community_roles:
-                repository_comunity_roles.add(CommunityRole(community.id, role))
-        return repository_comunity_roles
+        return get_all_community_roles()
 
     @cached_property
-    def role_names(self) -> set[str]:
+    def role_names(self) -> frozenset[str]:
         """Return a set of all known community role names, as configured inside the invenio.cfg.
 
         :return:                a set of all known community role names
         """
-        return {role["name"] for role in current_app.config["COMMUNITIES_ROLES"]}
+        return frozenset(
+            map(itemgetter("name"), current_app.config["COMMUNITIES_ROLES"])
+        )
 
     def role_priority(self, role_name: str) -> int:
         """Return a priority of a given role name.
@@ -110,29 +200,100 @@ class CommunitySupport:
         :param new_community_roles:     Set of new community roles
         :param current_community_roles: Set of current community roles. If not passed, it is fetched from the database.
         """
-        if not current_community_roles:
-            current_community_roles = cls.get_user_community_membership(user)
+        pending_invitations: dict[UUID, UUID] | None = None
+        if current_community_roles is None:
+            current_community_roles, pending_invitations = (
+                cls.get_user_community_membership_with_invitations(user)
+            )
 
         for v in new_community_roles:
             assert isinstance(v, CommunityRole)
 
-        for community_role in new_community_roles - current_community_roles:
-            cls._add_user_community_membership(community_role, user)
+        if new_community_roles == current_community_roles:
+            # the common case on login - nothing has changed
+            return
+
+        log.info(
+            "Changing community roles of user %s: %d current, %d new",
+            user.id,
+            len(current_community_roles),
+            len(new_community_roles),
+        )
+        log.debug("Current community roles %s", current_community_roles)
+        log.debug("New community roles %s", new_community_roles)
+
+        added_community_roles = new_community_roles - current_community_roles
+        removed_community_roles = current_community_roles - new_community_roles
+
+        # A change of the role inside a community is both an added and a removed role.
+        # The user can have only a single membership in a community, so the existing
+        # membership is updated instead of adding a new one and removing the old one.
+        removed_community_ids = {r.community_id for r in removed_community_roles}
+        updated_community_roles = {
+            r for r in added_community_roles if r.community_id in removed_community_ids
+        }
+        added_community_roles -= updated_community_roles
+        removed_community_ids -= {r.community_id for r in updated_community_roles}
 
-        log.info("Current community roles %s", current_community_roles)
-        log.info("New community roles %s", new_community_roles)
+        if added_community_roles and pending_invitations is None:
+            _, pending_invitations = cls.get_user_community_membership_with_invitations(
+                user
+            )
 
-        community_ids = {
-            r.community_id for r in current_community_roles - new_community_roles
-        }
-        for community_id in community_ids:
-            try:
-                cls._remove_user_community_membership(community_id, user)
-            except ValidationError as e:
-                # This is a case when the user is the last member of a community - in this case he can not be removed
-                log.error(
-                    f"Failed to remove user {user.id} from community {community_id}: {e}"
-                )
+        # all the changes are committed (and indexed) at once at the end of the unit of work
+        # instead of committing after each added/removed membership
+        with UnitOfWork(db.session) as uow:
+            for community_role in added_community_roles:
+                try:
+                    cls._add_user_community_membership(
+                        community_role,
+                        user,
+                        invitation_request_id=pending_invitations.get(  # type: ignore
+                            community_role.community_id
+                        ),
+                        uow=uow,
+                    )
+                except AlreadyMemberError:
+                    # the current community roles passed by the caller were not up to date,
+                    # the user already is a member of the community, so just set the role
+                    log.warning(
+                        "User %s is already a member of community %s, updating the role",
+                        user.id,
+                        community_role.community_id,
+                    )
+                    cls._update_user_community_membership(community_role, user, uow=uow)
+
+            # A failed change (the user is the last owner of a community and can not be
+            # removed or demoted) is rolled back to its savepoint, so that nothing it has
+            # already written is committed together with the other changes.
+            for community_role in updated_community_roles:
+                try:
+                    with db.session.begin_nested():  # type: ignore
+                        cls._update_user_community_membership(
+                            community_role, user, uow=uow
+                        )
+                except ValidationError as e:
+                    log.error(
+                        "Failed to change role of user %s in community %s: %s",
+                        user.id,
+                        community_role.community_id,
+                        e,
+                    )
+
+            for community_id in removed_community_ids:
+                try:
+                    with db.session.begin_nested():  # type: ignore
+                        cls._remove_user_community_membership(
+                            community_id, user, uow=uow
+                        )
+                except ValidationError as e:
+                    log.error(
+                        "Failed to remove user %s from community %s: %s",
+                        user.id,
+                        community_id,
+                        e,
+                    )
+            uow.commit()
 
     @classmethod
     def get_user_community_membership(cls, user: User) -> set[CommunityRole]:
@@ -140,15 +301,36 @@ class CommunitySupport:
 
         :param user: User object
         """
-        ret = set()
-        for row in db.session.execute(  # type: ignore
-            select([MemberModel.community_id, MemberModel.role]).where(
-                MemberModel.user_id == user.id, MemberModel.active == true()
-            )
-        ):
-            ret.add(CommunityRole(row.community_id, row.role))
+        return cls.get_user_community_membership_with_invitations(user)[0]
+
+    @classmethod
+    def get_user_community_membership_with_invitations(
+        cls, user: User
+    ) -> tuple[set[CommunityRole], dict[UUID, UUID]]:
+        """Get user's actual community roles and pending invitations in a single query.
 
-        return ret
+        :param user: User object
+        :return:     a set of active community roles and a mapping of community id to the id
+                     of the invitation request for communities the user has been invited to
+        """
+        active_roles = set()
+        pending_invitations = {}
+        for community_id, role, active, request_id in db.session.execute(  # type: ignore
+            select(
+                [
+                    MemberModel.community_id,
+                    MemberModel.role,
+                    MemberModel.active,
+                    MemberModel.request_id,
+                ]
+            ).where(MemberModel.user_id == user.id)
+        ).tuples():
+            if active:
+                active_roles.add(CommunityRole(community_id, role))
+            elif request_id is not None:
+                pending_invitations[community_id] = request_id
+
+        return active_roles, pending_invitations
 
     @classmethod
     def get_user_list_community_membership(
@@ -158,65 +340,93 @@ class CommunitySupport:
 
         :param user_ids: List of user ids
         """
-        ret: dict[int, set[CommunityRole]] = {}
-        for row in db.session.execute(  # type: ignore
-            select(
-                [MemberModel.community_id, MemberModel.user_id, MemberModel.role]
-            ).where(MemberModel.user_id.in_(user_ids), MemberModel.active == true())  # type: ignore
-        ):
-            if row.user_id not in ret:
-                ret[row.user_id] = set()
-            ret[row.user_id].add(CommunityRole(row.community_id, row.role))
+        ret: defaultdict[int, set[CommunityRole]] = defaultdict(set)
+        user_ids = list(user_ids)
+        # keep the IN clause well below the database limit on bound parameters
+        for start in range(0, len(user_ids), MEMBERSHIP_QUERY_CHUNK_SIZE):
+            user_ids_chunk = user_ids[start : start + MEMBERSHIP_QUERY_CHUNK_SIZE]
+            for community_id, user_id, role in db.session.execute(  # type: ignore
+                select(
+                    [MemberModel.community_id, MemberModel.user_id, MemberModel.role]
+                )
+                .where(
+                    MemberModel.user_id.in_(user_ids_chunk),  # type: ignore
+                    MemberModel.active == true(),
+                )
+                .execution_options(yield_per=1000)
+            ).tuples():
+                ret[user_id].add(CommunityRole(community_id, role))
 
-        return ret
+        return dict(ret)
 
     @classmethod
     def _add_user_community_membership(
-        cls, community_role: CommunityRole, user: User
+        cls,
+        community_role: CommunityRole,
+        user: User,
+        invitation_request_id: UUID | None = None,
+        uow: UnitOfWork | None = None,
     ) -> None:
         """Add user to a community with a given role.
 
         :param community_role:          community role
         :param user:                    user object
+        :param invitation_request_id:   id of a pending invitation request of the user to the community
+        :param uow:                     unit of work, if not passed the change is committed immediately
         :return:                        A membership result item from service
         """
+        if invitation_request_id is not None:
+            # There is an invitation request for this user in repository
+            # and the user has already accepted it inside AAI (as the community/role pair arrived from AAI).
+            #
+            # We need to accept the invitation request here, thus the membership will become active.
+            # A new membership can not be added as there already is an (inactive) one.
+            current_communities.service.members.accept_invitation(
+                system_identity, str(invitation_request_id), uow=uow
+            )
+            return None
+
         data = {
             "role": community_role.role,
             "members": [{"type": "user", "id": str(user.id)}],
         }
-        try:
-            return current_communities.service.members.add(
-                system_identity, community_role.community_id, data
-            )
-        except AlreadyMemberError:
-            # We are here because
-            #
-            # * active memberships have not returned this (community, role) for user
-            # * but the new membership could not be created because there already is a one
-            #
-            # This means that there is an invitation request for this user in repository
-            # and the user has already accepted it inside AAI (as the community/role pair arrived from AAI).
-            #
-            # We need to get the associated invitation request and accept it here,
-            # thus the membership will become active.
-            results = current_communities.service.members.search_invitations(
-                system_identity,
-                community_role.community_id,
-                params={"user.id": str(user.id)},
-            )
-            hits = list(results.hits)
-            if len(hits) == 1:
-                current_communities.service.members.accept_invitation(
-                    system_identity, hits[0]["request_id"]
-                )
+        return current_communities.service.members.add(
+            system_identity, community_role.community_id, data, uow=uow
+        )
 
     @classmethod
-    def _remove_user_community_membership(cls, community_id: UUID, user: User) -> None:
+    def _update_user_community_membership(
+        cls,
+        community_role: CommunityRole,
+        user: User,
+        uow: UnitOfWork | None = None,
+    ) -> None:
+        """Change the role of an existing membership of the user in a community.
+
+        :param community_role:      community role with the new role
+        :param user:                user object
+        :param uow:                 unit of work, if not passed the change is committed immediately
+        """
+        data = {
+            "role": community_role.role,
+            "members": [{"type": "user", "id": str(user.id)}],
+        }
+        current_communities.service.members.update(
+            system_identity, community_role.community_id, data, uow=uow
+        )
+
+    @classmethod
+    def _remove_user_community_membership(
+        cls, community_id: UUID, user: User, uow: UnitOfWork | None = None
+    ) -> None:
         """Remove user from a community with a given role.
 
         :param community_id:        id of the community
         :param user:                user object
+        :param uow:                 unit of work, if not passed the change is committed immediately
         :return:
         """
         data = {"members": [{"type": "user", "id": str(user.id)}]}
-        current_communities.service.members.delete(system_identity, community_id, data)
+        current_communities.service.members.delete(
+            system_identity, community_id, data, uow=uow
+        )
@@ -7,6 +7,16 @@
 #
 """Configuration for the E-INFRA OIDC authentication, can be overwritten in invenio.cfg ."""
 
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.types import PublicKeyTypes
+
 EINFRA_COMMUNITY_SYNCHRONIZATION = True
 """Synchronize community to E-Infra Perun when community is created."""
 
@@ -17,7 +27,15 @@ EINFRA_COMMUNITY_INVITATION_SYNCHRONIZATION = True
 EINFRA_COMMUNITY_MEMBER_SYNCHRONIZATION = True
 """Synchronize community membership to E-Infra Perun when user changes role within a community."""
 
-EINFRA_ENTITLEMENT_NAMESPACES = {"geant"}
+EINFRA_COMMUNITY_SYNC_CACHE_TIMEOUT = 24 * 60 * 60
+"""How long (in seconds) a successful community synchronization is remembered, so that
+the synchronization of unchanged communities can be skipped (see synchronize_all_communities --skip-unchanged)."""
+
+EINFRA_COMMUNITY_CACHE_TIMEOUT = 60
+"""How long (in seconds) the mapping of community slugs to ids is cached in a process.
+Changes made within the same process invalidate the cache immediately."""
+
+EINFRA_ENTITLEMENT_NAMESPACES = frozenset({"geant"})
 """URN prefix for capabilities that can represent community roles."""
 
 EINFRA_ENTITLEMENT_PREFIX = "cesnet.cz"
@@ -32,6 +50,26 @@ EINFRA_API_URL = "https://perun-api.e-infra.cz"
 EINFRA_RSA_KEY = b"-----BEGIN PUBLIC KEY-----\nMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEAmho5h/lz6USUUazQaVT3\nPHloIk/Ljs2vZl/RAaitkXDx6aqpl1kGpS44eYJOaer4oWc6/QNaMtynvlSlnkuW\nrG765adNKT9sgAWSrPb81xkojsQabrSNv4nIOWUQi0Tjh0WxXQmbV+bMxkVaElhd\nHNFzUfHv+XqI8Hkc82mIGtyeMQn+VAuZbYkVXnjyCwwa9RmPOSH+O4N4epDXKk1V\nK9dUxf/rEYbjMNZGDva30do0mrBkU8W3O1mDVJSSgHn4ejKdGNYMm0JKPAgCWyPW\nJDoL092ctPCFlUMBBZ/OP3omvgnw0GaWZXxqSqaSvxFJkqCHqLMwpxmWTTAgEvAb\nnwIDAQAB\n-----END PUBLIC KEY-----\n"
 """Public RSA key for verifying the OIDC token signature."""
 
+
+@lru_cache(maxsize=8)
+def get_rsa_public_key(
+    key: bytes | str | PublicKeyTypes = EINFRA_RSA_KEY,
+) -> PublicKeyTypes:
+    """Return a parsed public key for verifying the OIDC token signature.
+
+    The PEM is parsed only once for each distinct key and the parsed key
+    is reused by subsequent signature verifications.
+
+    :param key:     PEM encoded public key (str or bytes) or an already parsed key
+    :return:        the parsed key
+    """
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    if isinstance(key, bytes):
+        return load_pem_public_key(key)
+    return key
+
+
 #
 # At least the following should be sent in your invenio.cfg
 #
@@ -54,6 +92,10 @@ EINFRA_RSA_KEY = b"-----BEGIN PUBLIC KEY-----\nMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AM
 EINFRA_CAPABILITIES_ATTRIBUTE_NAME = "urn:perun:resource:attribute-def:def:capabilities"
 """urn of the attribute in the E-INFRA Perun that represents the capabilities."""
 
+EINFRA_SEARCH_RESOURCES_BY_CAPABILITY = False
+"""If True, resources are looked up by their capability with the Perun searcher.
+Otherwise all resources of the repository facility are fetched and filtered locally."""
+
 # EINFRA_SYNC_SERVICE_NAME = "..."
 # """name of the service in the E-INFRA Perun that is responsible for synchronization
 # (creating and pushing dumps with resources and users)."""
@@ -91,3 +133,8 @@ EINFRA_USER_PREFERRED_MAIL_ATTRIBUTE = "urn:perun:user:attribute-def:def:preferr
 
 EINFRA_DEFAULT_INVITATION_LANGUAGE = "en"
 """Language of the invitation emails that are sent to the users."""
+
+DEFAULTS = tuple(
+    (key, value) for key, value in globals().items() if key.startswith("EINFRA_")
+)
+"""Default values of all the EINFRA_ configuration options, used to initialize the app config."""
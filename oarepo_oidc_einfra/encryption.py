@@ -5,25 +5,35 @@
 # modify it under the terms of the MIT License; see LICENSE file for more
 # details.
 #
-"""Encryption and decryption of request id using FernetEngine encryption."""
+"""Encryption and decryption of request id using Fernet encryption."""
 
+import base64
+import hashlib
+from functools import lru_cache
 from uuid import UUID
 
+from cryptography.fernet import Fernet
 from flask import current_app
-from sqlalchemy_utils.types.encrypted.encrypted_type import FernetEngine
 
 
 def encrypt(request_id: str | UUID) -> str:
-    """Encrypt the request id using FernetEngine encryption."""
-    return _get_engine().encrypt(str(request_id))
+    """Encrypt the request id using Fernet encryption."""
+    return _get_fernet().encrypt(str(request_id).encode("utf-8")).decode("utf-8")
 
 
 def decrypt(encrypted_request_id: str) -> str:
-    """Decrypt the request id using FernetEngine encryption."""
-    return _get_engine().decrypt(encrypted_request_id)
+    """Decrypt the request id using Fernet encryption."""
+    return _get_fernet().decrypt(encrypted_request_id.encode("utf-8")).decode("utf-8")
 
 
-def _get_engine() -> FernetEngine:
-    engine = FernetEngine()
-    engine._update_key(current_app.config["SECRET_KEY"])
-    return engine
+def _get_fernet() -> Fernet:
+    return _fernet_for(current_app.config["SECRET_KEY"])
+
+
+@lru_cache(maxsize=4)
+def _fernet_for(secret_key: str | bytes) -> Fernet:
+    # the key is derived in the same way as sqlalchemy_utils' FernetEngine does it,
+    # so that the already sent (encrypted) links remain valid
+    if isinstance(secret_key, str):
+        secret_key = secret_key.encode("utf-8")
+    return Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret_key).digest()))
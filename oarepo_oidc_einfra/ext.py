@@ -7,28 +7,23 @@
 #
 """A flask extension for E-INFRA OIDC authentication."""
 
+from __future__ import annotations
+
 import threading
 from functools import cached_property
+from typing import TYPE_CHECKING
 
-import boto3
-import botocore.client
-from flask import Flask, current_app
-from invenio_communities.communities.services.components import (
-    DefaultCommunityComponents,
-)
-from invenio_communities.members.services.components import (
-    DefaultCommunityMemberComponents,
-)
+# boto3, the cli and the service components are imported only when they are needed,
+# so that processes that never touch the dumps do not pay for importing them
 
-from oarepo_oidc_einfra.perun import PerunLowLevelAPI
-from oarepo_oidc_einfra.services.components.aai_communities import CommunityAAIComponent
-from oarepo_oidc_einfra.services.components.aai_invitations import (
-    AAIInvitationComponent,
-)
+if TYPE_CHECKING:
+    import botocore.client
+    from flask import Flask
 
-from .cli import einfra as einfra_cmd
+    from oarepo_oidc_einfra.perun import PerunLowLevelAPI
 
 boto3_client_lock = threading.Lock()
+perun_api_lock = threading.Lock()
 
 
 class EInfraOIDCApp:
@@ -36,13 +31,24 @@ class EInfraOIDCApp:
 
     def __init__(self, app: Flask | None = None):
         """Create the extension."""
+        self._perun_api: PerunLowLevelAPI | None = None
+        self._perun_api_settings: tuple[str, str, str] | None = None
+        self._dump_boto3_client: botocore.client.BaseClient | None = None
         if app:
             self.init_app(app)
 
     def init_app(self, app: Flask) -> None:
         """Add the extension to the app and loads initial configuration."""
         app.extensions["einfra-oidc"] = self
+        # The extension is created for a single application, so its config is kept here
+        # instead of resolving the current_app proxy on every access. It is the same
+        # (mutable) object as app.config, so changes made to it later are seen, with the
+        # exception of the cached values (see reload_config).
+        self._config = app.config
         self.init_config(app)
+
+        from .cli import einfra as einfra_cmd
+
         app.cli.add_command(einfra_cmd)
 
     def init_config(self, app: Flask) -> None:
@@ -52,12 +58,30 @@ class EInfraOIDCApp:
         # sets the default configuration values
         from . import config
 
-        for k in dir(config):
-            if k.startswith("EINFRA_"):
-                app.config.setdefault(k, getattr(config, k))
+        app.config.update({k: v for k, v in config.DEFAULTS if k not in app.config})
+
+        # the namespaces are checked for every entitlement of a user,
+        # so make sure that the lookup is a hash lookup even if a list is configured
+        app.config["EINFRA_ENTITLEMENT_NAMESPACES"] = frozenset(
+            app.config["EINFRA_ENTITLEMENT_NAMESPACES"]
+        )
 
     def register_sync_component_to_community_service(self, app: Flask) -> None:
         """Register components to the community service."""
+        from invenio_communities.communities.services.components import (
+            DefaultCommunityComponents,
+        )
+        from invenio_communities.members.services.components import (
+            DefaultCommunityMemberComponents,
+        )
+
+        from oarepo_oidc_einfra.services.components.aai_communities import (
+            CommunityAAIComponent,
+        )
+        from oarepo_oidc_einfra.services.components.aai_invitations import (
+            AAIInvitationComponent,
+        )
+
         # Community -> AAI synchronization service component
         communities_components = app.config.get("COMMUNITIES_SERVICE_COMPONENTS", None)
         if isinstance(communities_components, list):
@@ -81,102 +105,150 @@ class EInfraOIDCApp:
             ]
 
     def perun_api(self) -> PerunLowLevelAPI:
-        """Create a new Perun API instance."""
-        return PerunLowLevelAPI(
-            base_url=current_app.config["EINFRA_API_URL"],
-            service_username=current_app.config["EINFRA_SERVICE_USERNAME"],
-            service_password=current_app.config["EINFRA_SERVICE_PASSWORD"],
+        """Return the Perun API instance.
+
+        The instance is shared, so that the connections to Perun are reused across calls.
+        It is created again if the Perun url or credentials in the configuration change.
+        """
+        settings = (
+            self._config["EINFRA_API_URL"],
+            self._config["EINFRA_SERVICE_USERNAME"],
+            self._config["EINFRA_SERVICE_PASSWORD"],
         )
+        if self._perun_api is None or self._perun_api_settings != settings:
+            from oarepo_oidc_einfra.perun import PerunLowLevelAPI
+
+            with perun_api_lock:
+                if self._perun_api is None or self._perun_api_settings != settings:
+                    # the previous instance is not closed, it might still be in use by other threads
+                    base_url, service_username, service_password = settings
+                    self._perun_api = PerunLowLevelAPI(
+                        base_url=base_url,
+                        service_username=service_username,
+                        service_password=service_password,
+                    )
+                    self._perun_api_settings = settings
+        return self._perun_api
+
+    # The following values are read from the configuration (or looked up in Perun)
+    # only once, on the first access, as they do not change during the lifetime
+    # of the application. Call reload_config after changing them in app.config.
+
+    _cached_settings = (
+        "repository_vo_id",
+        "repository_facility_id",
+        "communities_group_id",
+        "capabilities_attribute_id",
+        "capabilities_attribute_name",
+        "sync_service_id",
+        "default_language",
+        "einfra_user_id_search_attribute",
+        "einfra_user_id_dump_attribute",
+        "user_display_name_attribute",
+        "user_organization_attribute",
+        "user_preferred_mail_attribute",
+    )
+    """Names of the cached properties holding the values read from the configuration."""
+
+    def reload_config(self) -> None:
+        """Forget the cached configuration values, they are read again on the next access."""
+        for name in self._cached_settings:
+            self.__dict__.pop(name, None)
 
-    @property
+    @cached_property
     def repository_vo_id(self) -> int:
         """Get the repository VO ID."""
-        return current_app.config["EINFRA_REPOSITORY_VO_ID"]
+        return self._config["EINFRA_REPOSITORY_VO_ID"]
 
-    @property
+    @cached_property
     def repository_facility_id(self) -> int:
         """Get the repository facility ID."""
-        return current_app.config["EINFRA_REPOSITORY_FACILITY_ID"]
+        return self._config["EINFRA_REPOSITORY_FACILITY_ID"]
 
-    @property
+    @cached_property
     def communities_group_id(self) -> int:
         """Get the communities group ID."""
-        return current_app.config["EINFRA_COMMUNITIES_GROUP_ID"]
+        return self._config["EINFRA_COMMUNITIES_GROUP_ID"]
 
     @cached_property
     def capabilities_attribute_id(self) -> int:
         """Get the capabilities attribute ID."""
         return self.perun_api().get_attribute_by_name(
-            current_app.config["EINFRA_CAPABILITIES_ATTRIBUTE_NAME"]
+            self._config["EINFRA_CAPABILITIES_ATTRIBUTE_NAME"]
         )["id"]
 
-    @property
+    @cached_property
     def capabilities_attribute_name(self) -> str:
         """Get the capabilities attribute name."""
-        return current_app.config["EINFRA_CAPABILITIES_ATTRIBUTE_NAME"]
+        return self._config["EINFRA_CAPABILITIES_ATTRIBUTE_NAME"]
+
+    @property
+    def search_resources_by_capability(self) -> bool:
+        """Use the Perun searcher to look up resources by capability."""
+        return self._config["EINFRA_SEARCH_RESOURCES_BY_CAPABILITY"]
 
     @cached_property
     def sync_service_id(self) -> int:
         """Get the synchronization service ID."""
         return self.perun_api().get_service_by_name(
-            current_app.config["EINFRA_SYNC_SERVICE_NAME"]
+            self._config["EINFRA_SYNC_SERVICE_NAME"]
         )["id"]
 
-    @property
+    @cached_property
     def default_language(self) -> str:
         """Get the default language."""
-        return current_app.config["EINFRA_DEFAULT_INVITATION_LANGUAGE"]
+        return self._config["EINFRA_DEFAULT_INVITATION_LANGUAGE"]
 
-    @property
+    @cached_property
     def einfra_user_id_search_attribute(self) -> str:
         """Get the user EInfra ID attribute."""
-        return current_app.config["EINFRA_USER_ID_SEARCH_ATTRIBUTE"]
+        return self._config["EINFRA_USER_ID_SEARCH_ATTRIBUTE"]
 
-    @property
+    @cached_property
     def einfra_user_id_dump_attribute(self) -> str:
         """Get the user persistent EInfra ID attribute."""
-        return current_app.config["EINFRA_USER_ID_DUMP_ATTRIBUTE"]
+        return self._config["EINFRA_USER_ID_DUMP_ATTRIBUTE"]
 
-    @property
+    @cached_property
     def user_display_name_attribute(self) -> str:
         """Get the user display name attribute."""
-        return current_app.config["EINFRA_USER_DISPLAY_NAME_ATTRIBUTE"]
+        return self._config["EINFRA_USER_DISPLAY_NAME_ATTRIBUTE"]
 
-    @property
+    @cached_property
     def user_organization_attribute(self) -> str:
         """Get the user organization attribute."""
-        return current_app.config["EINFRA_USER_ORGANIZATION_ATTRIBUTE"]
+        return self._config["EINFRA_USER_ORGANIZATION_ATTRIBUTE"]
 
-    @property
+    @cached_property
     def user_preferred_mail_attribute(self) -> str:
         """Get the user preferred mail attribute."""
-        return current_app.config["EINFRA_USER_PREFERRED_MAIL_ATTRIBUTE"]
+        return self._config["EINFRA_USER_PREFERRED_MAIL_ATTRIBUTE"]
 
     @property
     def dump_s3_bucket(self) -> str:
         """Get the dump S3 bucket name."""
-        return current_app.config["EINFRA_USER_DUMP_S3_BUCKET"]
+        return self._config["EINFRA_USER_DUMP_S3_BUCKET"]
 
     @property
-    def entitlement_namespaces(self) -> list[str]:
+    def entitlement_namespaces(self) -> frozenset[str]:
         """Get the entitlement namespaces."""
-        return current_app.config["EINFRA_ENTITLEMENT_NAMESPACES"]
+        return self._config["EINFRA_ENTITLEMENT_NAMESPACES"]
 
     @property
     def entitlement_prefix(self) -> str:
         """Get the entitlement prefix."""
-        return current_app.config["EINFRA_ENTITLEMENT_PREFIX"]
+        return self._config["EINFRA_ENTITLEMENT_PREFIX"]
 
     @property
     def synchronization_enabled(self) -> bool:
         """Is the synchronization enabled."""
-        return current_app.config["EINFRA_COMMUNITY_SYNCHRONIZATION"]
+        return self._config["EINFRA_COMMUNITY_SYNCHRONIZATION"]
 
     @property
     def invitation_synchronization_enabled(self) -> bool:
         """Is the invitation synchronization enabled."""
         return (
-            current_app.config["EINFRA_COMMUNITY_INVITATION_SYNCHRONIZATION"]
+            self._config["EINFRA_COMMUNITY_INVITATION_SYNCHRONIZATION"]
             and self.synchronization_enabled
         )
 
@@ -184,21 +256,37 @@ class EInfraOIDCApp:
     def members_synchronization_enabled(self) -> bool:
         """Is the members synchronization enabled."""
         return (
-            current_app.config["EINFRA_COMMUNITY_MEMBER_SYNCHRONIZATION"]
+            self._config["EINFRA_COMMUNITY_MEMBER_SYNCHRONIZATION"]
             and self.synchronization_enabled
         )
 
-    @cached_property
+    @property
     def dump_boto3_client(self) -> botocore.client.BaseClient:
+        """Return the boto3 client for the dump, creating it on the first access."""
+        if self._dump_boto3_client is None:
+            with boto3_client_lock:
+                # see https://stackoverflow.com/questions/52820971/is-boto3-client-thread-safe
+                # why this lock is here
+                if self._dump_boto3_client is None:
+                    self._dump_boto3_client = self._create_dump_boto3_client()
+        return self._dump_boto3_client
+
+    def _create_dump_boto3_client(self) -> botocore.client.BaseClient:
         """Create a new boto3 client for the dump."""
-        with boto3_client_lock:
-            # see https://stackoverflow.com/questions/52820971/is-boto3-client-thread-safe
-            # why this lock is here
-            return boto3.client(
-                "s3",
-                aws_access_key_id=current_app.config["EINFRA_USER_DUMP_S3_ACCESS_KEY"],
-                aws_secret_access_key=current_app.config[
-                    "EINFRA_USER_DUMP_S3_SECRET_KEY"
-                ],
-                endpoint_url=current_app.config["EINFRA_USER_DUMP_S3_ENDPOINT"],
-            )
+        import boto3
+        import botocore.config
+
+        return boto3.client(
+            "s3",
+            aws_access_key_id=self._config["EINFRA_USER_DUMP_S3_ACCESS_KEY"],
+            aws_secret_access_key=self._config["EINFRA_USER_DUMP_S3_SECRET_KEY"],
+            endpoint_url=self._config["EINFRA_USER_DUMP_S3_ENDPOINT"],
+            # shared by all dump operations, so keep a warm, large enough connection pool
+            config=botocore.config.Config(
+                max_pool_connections=50,
+                tcp_keepalive=True,
+                retries={"max_attempts": 5, "mode": "adaptive"},
+                connect_timeout=3,
+                read_timeout=30,
+            ),
+        )
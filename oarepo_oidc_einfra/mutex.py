@@ -13,15 +13,29 @@ a mutex that works in all cases of disaster scenarios.
 """
 
 import functools
+import itertools
+import os
 import secrets
 import threading
 import time
 from random import random
-from typing import Callable
+from typing import Any, Callable
 
 from invenio_cache import current_cache
 
 
+def _redis_client() -> Any | None:  # noqa: ANN401
+    """Return the redis client of the cache if the cache is backed by redis."""
+    client = getattr(current_cache.cache, "_write_client", None)
+    if client is not None and hasattr(client, "blpop"):
+        return client
+    return None
+
+
+_mutex_counter = itertools.count()
+"""Distinguishes mutex instances created within the same thread."""
+
+
 class CacheMutex:
     """A simple mutex implementation using the cache.
 
@@ -34,14 +48,25 @@ class CacheMutex:
     """
 
     def __init__(
-        self, key: str, timeout: float = 3600, tries: int = 10, wait_time: float = 120
+        self,
+        key: str,
+        timeout: float = 3600,
+        tries: int = 10,
+        wait_time: float = 120,
+        initial_wait_time: float = 1,
     ):
         """Create the mutex.
 
         :param key: The key inside cache where the mutex data are stored.
         :param timeout: The mutex will be released automatically after this time.
-        :param tries: The number of tries to acquire the lock if it is locked.
-        :param wait_time: The time to wait between the tries.
+        :param tries: Together with wait_time gives the time budget for acquiring the lock
+                      if it is locked: the lock is given up after tries * wait_time seconds.
+        :param wait_time: The maximum time to wait between the tries.
+        :param initial_wait_time: The time to wait after the first try, doubled after each next try.
+
+        The waiting backs off exponentially from initial_wait_time up to wait_time, so a lock
+        that is released soon is acquired soon, but the total time spent waiting for the lock
+        is the same as if each of the tries waited the full wait_time.
 
         Usage:
 
@@ -49,30 +74,38 @@ class CacheMutex:
             # do something that needs to be protected by the mutex
         """
         self.key = key
-        self.value = secrets.token_hex(32)
+        # unique for this process, thread and instance; the random part guards
+        # against pid/thread id reuse on different machines
+        self.value = (
+            f"{os.getpid()}-{threading.get_ident()}-"
+            f"{next(_mutex_counter)}-{secrets.token_hex(8)}"
+        )
         self.timeout = timeout
         self.tries = tries
         self.wait_time = wait_time
+        self.initial_wait_time = initial_wait_time
 
     def __enter__(self):
         """Acquires the mutex."""
-        for _k in range(self.tries):
+        budget = self.tries * self.wait_time
+        deadline = time.monotonic() + budget
+        for k in itertools.count():
+            # add is atomic, it succeeds only if the key has not been in the cache
             if current_cache.cache.add(self.key, self.value, timeout=self.timeout):
-                # sanity check
-                if current_cache.cache.get(self.key) != self.value:
-                    continue
                 return
-            # add random to desynchronize
-            time.sleep(self.wait_time * 0.9 + self.wait_time * 0.1 * random())
-        raise ValueError(
-            f"Could not acquire mutex for {self.tries} times, "
-            f"waiting {self.wait_time} seconds each time"
-        )
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # exponential backoff, add random to desynchronize
+            backoff = self.initial_wait_time * 2 ** min(k, 30) * (0.5 + random())
+            self._wait_for_release(min(self.wait_time, backoff, remaining))
+        raise ValueError(f"Could not acquire mutex within {budget} seconds")
 
     def __exit__(self, exc_type, exc_value, traceback):  # noqa
         """Releases the mutex."""
         if current_cache.cache.get(self.key) == self.value:
             current_cache.cache.delete(self.key)
+            self._notify_released()
 
     def force_clear(self) -> None:
         """Force the mutex to be cleared.
@@ -80,6 +113,35 @@ class CacheMutex:
         Note: this does not stop any processes that might be using the mutex !
         """
         current_cache.cache.delete(self.key)
+        self._notify_released()
+
+    @property
+    def _released_key(self) -> str:
+        """Redis list that is used to wake up a waiter when the mutex is released."""
+        return f"{getattr(current_cache.cache, 'key_prefix', '')}{self.key}:released"
+
+    def _wait_for_release(self, seconds: float) -> None:
+        """Wait until the mutex is released, at most the given number of seconds.
+
+        If the cache is backed by redis, the waiter blocks on a list that is pushed to
+        when the mutex is released, so it is woken up immediately. Otherwise it just sleeps.
+        """
+        client = _redis_client()
+        if client is None:
+            time.sleep(seconds)
+            return
+        client.blpop([self._released_key], timeout=max(1, round(seconds)))
+
+    def _notify_released(self) -> None:
+        """Wake up one of the waiters, if there are any."""
+        client = _redis_client()
+        if client is None:
+            return
+        pipeline = client.pipeline()
+        pipeline.rpush(self._released_key, 1)
+        # do not keep the notification if there has been no waiter
+        pipeline.expire(self._released_key, 10)
+        pipeline.execute()
 
 
 mutex_thread_local = threading.local()
@@ -94,7 +156,8 @@ def mutex(
     :param key: The key inside cache where the mutex data are stored.
     :param timeout: The mutex will be released automatically after this time.
     :param tries: The number of tries to acquire the lock if it is locked.
-    :param wait_time: The time to wait between the tries.
+    :param wait_time: The maximum time to wait between the tries. The lock is given up
+                      after tries * wait_time seconds, see CacheMutex.
 
     Within the same thread, the mutex with the same key is re-entrant.
 
@@ -108,13 +171,16 @@ def mutex(
     def decorator(func):  # noqa
         @functools.wraps(func)
         def wrapper(*args, **kwargs):  # noqa
-            if not hasattr(mutex_thread_local, key):
-                setattr(mutex_thread_local, key, True)
+            held = getattr(mutex_thread_local, "held", None)
+            if held is None:
+                held = mutex_thread_local.held = set()
+            if key not in held:
+                held.add(key)
                 try:
                     with CacheMutex(key, timeout, tries, wait_time):
                         return func(*args, **kwargs)
                 finally:
-                    delattr(mutex_thread_local, key)
+                    held.discard(key)
             else:
                 return func(*args, **kwargs)
 
@@ -7,13 +7,14 @@
 #
 """Perun API, dump and OIDC utilities."""
 
-from .api import DoesNotExist, PerunLowLevelAPI
+from .api import DoesNotExist, PerunError, PerunLowLevelAPI
 from .dump import PerunDumpData
 from .oidc import get_communities_from_userinfo_token
 
 __all__ = (
     "PerunLowLevelAPI",
     "DoesNotExist",
+    "PerunError",
     "get_communities_from_userinfo_token",
     "PerunDumpData",
 )
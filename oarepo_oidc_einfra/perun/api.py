@@ -7,20 +7,90 @@
 #
 """Low-level API for Perun targeted at the operations needed by E-INFRA OIDC extension."""
 
+import base64
+import hashlib
 import logging
+import socket
+import threading
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
-from typing import Optional, Tuple
+from typing import Any, Literal, Optional, Self, Tuple, overload
 
+import orjson
 import requests
-from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util import Retry
 
 log = logging.getLogger("perun")
 
+CONNECTION_POOL_SIZE = 32
+"""Number of pooled keep-alive connections to the Perun server."""
 
-class DoesNotExist(Exception):
+REQUEST_TIMEOUT = (5, 30)
+"""Connect and read timeout (in seconds) of a call to Perun."""
+
+LOOKUP_CACHE_TTL = 300
+"""How long (in seconds) are the results of lookups by name (services, attributes, resources) cached."""
+
+LOOKUP_CACHE_MAXSIZE = 256
+"""Maximum number of lookup results kept in the cache."""
+
+MEMBER_CACHE_TTL = 60
+"""How long (in seconds) are the VO members of users cached."""
+
+SUBGROUP_CACHE_TTL = 30
+"""How long (in seconds) are the subgroups of a parent group cached when looking up groups by name."""
+
+RESPONSE_CACHE_TTL = 300
+"""How long (in seconds) is the last response of a conditional call kept for reuse."""
+
+
+class PerunError(Exception):
+    """Exception raised when a call to Perun fails."""
+
+
+class DoesNotExist(PerunError):
     """Exception raised when a resource does not exist."""
 
 
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTP adapter that keeps idle pooled connections alive with TCP keepalive probes.
+
+    urllib3 already sets TCP_NODELAY by default, so small RPC posts are not delayed
+    by Nagle's algorithm; the keepalive probes keep the long-lived pooled connections
+    from being dropped by NATs and firewalls.
+    """
+
+    socket_options = (
+        *HTTPConnection.default_socket_options,
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        *(
+            (socket.IPPROTO_TCP, getattr(socket, option), value)
+            for option, value in (
+                ("TCP_KEEPIDLE", 60),
+                ("TCP_KEEPINTVL", 15),
+                ("TCP_KEEPCNT", 4),
+            )
+            # not available on all platforms
+            if hasattr(socket, option)
+        ),
+    )
+
+    def init_poolmanager(
+        self,
+        connections: int,
+        maxsize: int,
+        block: bool = False,
+        **pool_kwargs: object,
+    ) -> None:
+        """Initialize the pool manager with the keepalive socket options."""
+        pool_kwargs["socket_options"] = list(self.socket_options)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+
 class PerunLowLevelAPI:
     """Low-level API for Perun targeted at the operations needed by E-INFRA OIDC extension.
 
@@ -45,8 +115,85 @@ class PerunLowLevelAPI:
         :param service_password:    the password of the service that manages stuff
         """
         self._base_url = base_url
-        self._auth = HTTPBasicAuth(service_username, service_password)
-        self._session = requests.Session()
+        self._rpc_prefix = f"{base_url}/krb/rpc/json/"
+        self._rpc_urls: dict[tuple[str, str], str] = {}
+        # the basic auth header is computed once instead of by requests on every call
+        credentials = f"{service_username}:{service_password}".encode("latin1")
+        self._authorization = f"Basic {base64.b64encode(credentials).decode('ascii')}"
+        # idempotent calls are retried on transient errors, calls that create
+        # something (and might have succeeded on the server) are sent only once
+        self._session = self._create_session(
+            Retry(
+                total=4,
+                backoff_factor=0.3,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(["POST"]),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+        )
+        self._single_attempt_session = self._create_session(0)
+        self._lookup_cache: dict[tuple, tuple[float, dict]] = {}
+        self._lookup_cache_lock = threading.Lock()
+        self._subgroup_cache: dict[int, tuple[float, dict[str, dict]]] = {}
+        self._response_cache: dict[
+            bytes, tuple[float, str | None, bytes, dict | list]
+        ] = {}
+        self._attr_index_cache: dict[Any, tuple[dict, dict[tuple[str, str], Any]]] = {}
+        self._executor: ThreadPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
+
+    def _create_session(self, max_retries: Retry | int) -> requests.Session:
+        """Create a session with pooled keep-alive connections to Perun.
+
+        :param max_retries:     retry policy of the session's adapter
+        """
+        session = requests.Session()
+        # the instance is shared (see EInfraOIDCApp.perun_api), so keep enough
+        # pooled keep-alive connections to the Perun server for concurrent callers
+        adapter = KeepAliveAdapter(
+            pool_connections=CONNECTION_POOL_SIZE,
+            pool_maxsize=CONNECTION_POOL_SIZE,
+            max_retries=max_retries,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {
+                "Connection": "keep-alive",
+                "Content-Type": "application/json",
+                "Authorization": self._authorization,
+            }
+        )
+        return session
+
+    def close(self) -> None:
+        """Close the pooled connections to Perun and stop the worker threads."""
+        self._session.close()
+        self._single_attempt_session.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def _worker_pool(self) -> ThreadPoolExecutor:
+        """Thread pool shared by the concurrent calls to Perun, created on first use."""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    # at most as many threads as there are pooled connections
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=CONNECTION_POOL_SIZE, thread_name_prefix="perun"
+                    )
+        return self._executor
+
+    def __enter__(self) -> Self:
+        """Use the API as a context manager that closes the connections on exit."""
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        """Close the pooled connections to Perun."""
+        self.close()
 
     @cached_property
     def _service_id(self) -> int:
@@ -60,6 +207,63 @@ class PerunLowLevelAPI:
             {},
         )["id"]
 
+    def _cached_lookup(
+        self, key: tuple, lookup: Callable[[], dict], ttl: float = LOOKUP_CACHE_TTL
+    ) -> dict:
+        """Return the result of a lookup, cached for ttl seconds.
+
+        :param key:         cache key of the lookup
+        :param lookup:      function performing the lookup on cache miss
+        :param ttl:         how long (in seconds) the result is cached
+        :return:            a copy of the (possibly cached) result
+        """
+        cached = self._get_cached_lookup(key)
+        if cached is not None:
+            return cached
+        value = lookup()
+        self._cache_lookup(key, value, ttl)
+        return dict(value)
+
+    def _get_cached_lookup(self, key: tuple) -> dict | None:
+        """Return a copy of a cached lookup result or None if it is not cached or expired.
+
+        :param key:         cache key of the lookup
+        """
+        with self._lookup_cache_lock:
+            cached = self._lookup_cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return dict(cached[1])
+        return None
+
+    def _cache_lookup(
+        self, key: tuple, value: dict, ttl: float = LOOKUP_CACHE_TTL
+    ) -> None:
+        """Cache a lookup result.
+
+        :param key:         cache key of the lookup
+        :param value:       the result of the lookup
+        :param ttl:         how long (in seconds) the result is cached
+        """
+        with self._lookup_cache_lock:
+            self._lookup_cache.pop(key, None)
+            while len(self._lookup_cache) >= LOOKUP_CACHE_MAXSIZE:
+                # dicts keep insertion order, so this evicts the oldest entry
+                del self._lookup_cache[next(iter(self._lookup_cache))]
+            self._lookup_cache[key] = (time.monotonic() + ttl, value)
+
+    def _invalidate_lookup(self, key: tuple) -> None:
+        """Drop a single cached lookup.
+
+        :param key:         cache key of the lookup
+        """
+        with self._lookup_cache_lock:
+            self._lookup_cache.pop(key, None)
+
+    def invalidate_lookup_cache(self) -> None:
+        """Drop all cached lookups by name."""
+        with self._lookup_cache_lock:
+            self._lookup_cache.clear()
+
     def _perun_call_dict(self, manager: str, method: str, payload: dict) -> dict:
         """Low-level call to Perun API with error handling, call returns a dict.
 
@@ -82,31 +286,150 @@ class PerunLowLevelAPI:
         assert isinstance(ret, list)
         return ret
 
-    def _perun_call(self, manager: str, method: str, payload: dict) -> dict | list:
+    def _perun_call_many(self, calls: list[tuple[str, str, dict]]) -> list[dict | list]:
+        """Run independent calls to Perun API concurrently.
+
+        The calls share the session and thus its connection pool.
+
+        :param calls:       a list of (manager, method, payload) tuples
+        :return:            results of the calls, in the same order as the calls
+        """
+        if len(calls) <= 1:
+            return [self._perun_call(*call) for call in calls]
+        futures = [self._worker_pool.submit(self._perun_call, *call) for call in calls]
+        return [future.result() for future in futures]
+
+    @overload
+    def _perun_call(
+        self,
+        manager: str,
+        method: str,
+        payload: dict,
+        idempotent: bool | None = ...,
+        conditional: bool = ...,
+        *,
+        ok_not_found: Literal[False] = ...,
+    ) -> dict | list: ...
+
+    @overload
+    def _perun_call(
+        self,
+        manager: str,
+        method: str,
+        payload: dict,
+        idempotent: bool | None = ...,
+        conditional: bool = ...,
+        *,
+        ok_not_found: Literal[True],
+    ) -> dict | list | None: ...
+
+    def _perun_call(
+        self,
+        manager: str,
+        method: str,
+        payload: dict,
+        idempotent: bool | None = None,
+        conditional: bool = False,
+        *,
+        ok_not_found: bool = False,
+    ) -> dict | list | None:
         """Low-level call to Perun API with error handling.
 
         :param manager:     the manager to call
         :param method:      the method to call
         :param payload:     the json payload to send
+        :param idempotent:  if True, the call is retried on transient errors. If not set,
+                            only the read-only (get*) methods are retried
+        :param conditional: if True, the last response is remembered (for RESPONSE_CACHE_TTL
+                            seconds) and reused when the server returns 304 (for the ETag
+                            sent in If-None-Match) or the same content again. The result
+                            is shared by the callers and must not be modified.
+        :param ok_not_found: if True, return None instead of raising DoesNotExist
+                            when the object is not found
         """
-        resp = self._session.post(
-            f"{self._base_url}/krb/rpc/json/{manager}/{method}",
-            auth=self._auth,
-            json=payload,
+        if idempotent is None:
+            idempotent = method.startswith("get")
+        session = self._session if idempotent else self._single_attempt_session
+        body = orjson.dumps(payload)
+        headers: dict[str, str] | None = None
+
+        cache_key = b""
+        cached = None
+        if conditional:
+            cache_key = f"{manager}.{method}:".encode() + body
+            cached = self._response_cache.get(cache_key)
+            if cached is not None and cached[0] <= time.monotonic():
+                # expired, fetch and parse the response again
+                cached = None
+            if cached is not None and cached[1]:
+                headers = {"If-None-Match": cached[1]}
+
+        url = self._rpc_urls.get((manager, method))
+        if url is None:
+            # there is only a handful of (manager, method) pairs, so this stays small
+            url = self._rpc_urls[(manager, method)] = (
+                self._rpc_prefix + manager + "/" + method
+            )
+        resp = session.post(
+            url,
+            data=body,
+            headers=headers,
+            timeout=REQUEST_TIMEOUT,
         )
 
+        if resp.status_code == 304 and cached is not None:
+            return cached[3]
+
+        if 200 <= resp.status_code < 300:
+            if conditional:
+                digest = hashlib.blake2b(resp.content, digest_size=16).digest()
+                if cached is not None and cached[2] == digest:
+                    # unchanged content, skip parsing it again
+                    return cached[3]
+            response = orjson.loads(resp.content)
+            if conditional:
+                with self._lookup_cache_lock:
+                    self._response_cache.pop(cache_key, None)
+                    while len(self._response_cache) >= LOOKUP_CACHE_MAXSIZE:
+                        del self._response_cache[next(iter(self._response_cache))]
+                    self._response_cache[cache_key] = (
+                        time.monotonic() + RESPONSE_CACHE_TTL,
+                        resp.headers.get("ETag"),
+                        digest,
+                        response,
+                    )
+            # payload and response can be large, so they are rendered only at debug level
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(
+                    "Perun call %s.%s with payload %s returned %s",
+                    manager,
+                    method,
+                    payload,
+                    response,
+                )
+            return response
+
         if resp.status_code == 404:
+            if ok_not_found:
+                return None
             raise DoesNotExist(f"Not found returned for method {method} and {payload}")
 
-        if (
-            resp.status_code == 400
-            and resp.json().get("name") == "ResourceNotExistsException"
-        ):
-            raise DoesNotExist(f"Not found returned for method {method} and {payload}")
+        if resp.status_code == 400:
+            try:
+                error = orjson.loads(resp.content)
+            except orjson.JSONDecodeError:
+                error = None
+            if (
+                isinstance(error, dict)
+                and error.get("name") == "ResourceNotExistsException"
+            ):
+                if ok_not_found:
+                    return None
+                raise DoesNotExist(
+                    f"Not found returned for method {method} and {payload}"
+                )
 
-        if resp.status_code < 200 or resp.status_code >= 300:
-            raise Exception(f"Perun call failed: {resp.text}")
-        return resp.json()
+        raise PerunError(f"Perun call failed: {resp.text}")
 
     def create_group(
         self,
@@ -129,7 +452,6 @@ class PerunLowLevelAPI:
         # check if the group already exists and if not, create it
 
         group_created = False
-        admin_created = False
 
         group: dict | None
         if check_existing:
@@ -152,14 +474,30 @@ class PerunLowLevelAPI:
             )
 
             group_created = True
+            with self._lookup_cache_lock:
+                cached = self._subgroup_cache.get(parent_group_id)
+                if cached is not None:
+                    cached[1][name] = group
             log.info(
                 "Group %s within parent %s created, id %s",
                 name,
                 parent_group_id,
                 group["id"],
             )
+
+        get_admins = (
+            "groupsManager",
+            "getAdmins",
+            {"group": group["id"], "onlyDirectAdmins": 0},
+        )
+        admins: list | None = None
+        if group_created:
+            # copying the form and mails to the new group and fetching its admins
+            # are independent, so run them concurrently
+            executor = self._worker_pool
             # copy form to the group
-            self._perun_call(
+            copy_form = executor.submit(
+                self._perun_call,
                 "registrarManager",
                 "copyForm",
                 {
@@ -167,9 +505,11 @@ class PerunLowLevelAPI:
                     "toGroup": group["id"],
                     "idempotent": True,
                 },
+                idempotent=True,
             )
             # copy mails from the parent to the group
-            self._perun_call(
+            copy_mails = executor.submit(
+                self._perun_call,
                 "registrarManager",
                 "copyMails",
                 {
@@ -177,28 +517,62 @@ class PerunLowLevelAPI:
                     "toGroup": group["id"],
                 },
             )
+            admins_future = executor.submit(self._perun_call_list, *get_admins)
+            copy_form.result()
+            copy_mails.result()
+            admins = admins_future.result()
 
         # check if the group has the service as an admin and if not, add it
         # if inheritance works, do not duplicate the admin here
-        admins = self._perun_call(
-            "groupsManager", "getAdmins", {"group": group["id"], "onlyDirectAdmins": 0}
-        )
-        for admin in admins:
-            if str(admin["id"]) == str(self._service_id):
-                break
-        else:
-            log.info(
-                "Adding service %s as admin to group %s", self._service_id, group["id"]
-            )
-            self._perun_call(
+        admin_created = self._ensure_assigned(
+            items=admins,
+            fetch=get_admins,
+            target_id=self._service_id,
+            assign=(
                 "groupsManager",
                 "addAdmin",
                 {"group": group["id"], "user": self._service_id},
-            )
-            admin_created = True
+            ),
+            description=(
+                "service %s as admin of group %s",
+                self._service_id,
+                group["id"],
+            ),
+        )
 
         return (group, group_created, admin_created)
 
+    def _ensure_assigned(
+        self,
+        *,
+        fetch: tuple[str, str, dict],
+        target_id: int,
+        assign: tuple[str, str, dict],
+        description: tuple[Any, ...],
+        items: list | None = None,
+    ) -> bool:
+        """Make the assign call unless an item with the target id is already present.
+
+        :param fetch:           (manager, method, payload) of the call that lists the present items
+        :param target_id:       id of the item that should be present
+        :param assign:          (manager, method, payload) of the call that adds the item
+        :param description:     description of the assignment for the log, a format string
+                                followed by its arguments (formatted only when logged)
+        :param items:           already fetched items, the fetch call is not made if passed
+        :return:                True if the item has been assigned by this call
+        """
+        if items is None:
+            items = self._perun_call_list(*fetch)
+        # Perun ids are integers, but they may be passed in as strings (for example
+        # from the configuration), so both sides are compared as int
+        if int(target_id) in {int(item["id"]) for item in items}:
+            return False
+        message, *args = description
+        log.info("Assigning " + message, *args)
+        self._perun_call(*assign)
+        log.info("Assigned " + message, *args)
+        return True
+
     def get_group_by_name(self, name: str, parent_group_id: int) -> Optional[dict]:
         """Get a group by name within a parent group.
 
@@ -206,13 +580,26 @@ class PerunLowLevelAPI:
         :param parent_group_id:     ID of the parent group
         :return:                    group or None if not found
         """
-        groups = self._perun_call(
-            "groupsManager", "getAllSubGroups", {"group": parent_group_id}
-        )
-        for group in groups:
-            if group["shortName"] == name:
-                return group
-        return None
+        now = time.monotonic()
+        with self._lookup_cache_lock:
+            cached = self._subgroup_cache.get(parent_group_id)
+        if cached is None or now - cached[0] >= SUBGROUP_CACHE_TTL:
+            groups = self._perun_call(
+                "groupsManager",
+                "getAllSubGroups",
+                {"group": parent_group_id},
+                conditional=True,
+            )
+            assert isinstance(groups, list)
+            # reversed, so that the first group with the name wins as before
+            subgroups = {group["shortName"]: group for group in reversed(groups)}
+            with self._lookup_cache_lock:
+                self._subgroup_cache[parent_group_id] = (now, subgroups)
+        else:
+            subgroups = cached[1]
+        group = subgroups.get(name)
+        # the cached groups are shared, so the caller gets its own copy
+        return dict(group) if group is not None else None
 
     def create_resource_with_group_and_capabilities(
         self,
@@ -249,11 +636,37 @@ class PerunLowLevelAPI:
 
         resource_id = resource["id"]
 
-        self.assign_group_to_resource(resource_id, group_id)
+        # the current state of the resource is fetched concurrently, as the calls
+        # do not depend on each other; then only the missing parts are set
+        assigned_groups, capabilities_attr, assigned_services = self._perun_call_many(
+            [
+                ("resourcesManager", "getAssignedGroups", {"resource": resource_id}),
+                (
+                    "attributesManager",
+                    "getAttribute",
+                    {"resource": resource_id, "attributeId": capability_attr_id},
+                ),
+                ("resourcesManager", "getAssignedServices", {"resource": resource_id}),
+            ]
+        )
+        assert isinstance(assigned_groups, list)
+        assert isinstance(capabilities_attr, dict)
+        assert isinstance(assigned_services, list)
 
-        self.set_resource_capabilities(resource_id, capability_attr_id, capabilities)
+        self.assign_group_to_resource(
+            resource_id, group_id, assigned_groups=assigned_groups
+        )
 
-        self.attach_service_to_resource(resource_id, perun_sync_service_id)
+        self.set_resource_capabilities(
+            resource_id,
+            capability_attr_id,
+            frozenset(capabilities),
+            capabilities_attr=capabilities_attr,
+        )
+
+        self.attach_service_to_resource(
+            resource_id, perun_sync_service_id, assigned_services=assigned_services
+        )
 
         return resource, resource_created
 
@@ -298,6 +711,7 @@ class PerunLowLevelAPI:
                 },
             )
             resource_created = True
+            self.invalidate_lookup_cache()
             log.info(
                 "Resource %s created in facility %s and vo %s, id %s",
                 name,
@@ -307,89 +721,103 @@ class PerunLowLevelAPI:
             )
         return resource, resource_created
 
-    def assign_group_to_resource(self, resource_id: int, group_id: int) -> None:
+    def assign_group_to_resource(
+        self,
+        resource_id: int,
+        group_id: int,
+        assigned_groups: list | None = None,
+    ) -> None:
         """Assign a group to a resource.
 
         :param resource_id:         id of the resource
         :param group_id:            id of the group to be assigned
+        :param assigned_groups:     groups already assigned to the resource, fetched if not passed
         """
-        groups = self._perun_call(
-            "resourcesManager",
-            "getAssignedGroups",
-            {
-                "resource": resource_id,
-            },
-        )
-        for grp in groups:
-            if str(grp["id"]) == str(group_id):
-                break
-        else:
-            log.info("Assigning group %s to resource %s", group_id, resource_id)
-            self._perun_call(
+        self._ensure_assigned(
+            items=assigned_groups,
+            fetch=("resourcesManager", "getAssignedGroups", {"resource": resource_id}),
+            target_id=group_id,
+            assign=(
                 "resourcesManager",
                 "assignGroupToResource",
                 {"resource": resource_id, "group": group_id},
-            )
-            log.info("Group %s assigned to resource %s", group_id, resource_id)
+            ),
+            description=("group %s to resource %s", group_id, resource_id),
+        )
 
     def set_resource_capabilities(
-        self, resource_id: int, capability_attr_id: int, capabilities: list[str]
+        self,
+        resource_id: int,
+        capability_attr_id: int,
+        capabilities: Iterable[str],
+        capabilities_attr: dict | None = None,
     ) -> None:
         """Set capabilities to a resource.
 
         :param resource_id:             id of the resource
         :param capability_attr_id:      internal id of the attribute that holds the capabilities
-        :param capabilities:            list of capabilities to be set
+        :param capabilities:            capabilities to be set, preferably a frozenset
+        :param capabilities_attr:       the current capabilities attribute of the resource, fetched if not passed
         """
-        # check if the resource has the capability and if not, add it
-        attr = self._perun_call_dict(
-            "attributesManager",
-            "getAttribute",
-            {"resource": resource_id, "attributeId": capability_attr_id},
+        needed = (
+            capabilities
+            if isinstance(capabilities, frozenset)
+            else frozenset(capabilities)
         )
-        value = attr["value"] or []
-        if not (set(value) >= set(capabilities)):
-            log.info(
-                "Setting capabilities %s to resource %s", capabilities, resource_id
-            )
-            attr["value"] = list(set(value) | set(capabilities))
-            self._perun_call(
+        if not needed:
+            return
+        # check if the resource has the capability and if not, add it
+        if capabilities_attr is None:
+            capabilities_attr = self._perun_call_dict(
                 "attributesManager",
-                "setAttribute",
-                {"resource": resource_id, "attribute": attr},
+                "getAttribute",
+                {"resource": resource_id, "attributeId": capability_attr_id},
             )
-            log.info("Capabilities %s set to resource %s", capabilities, resource_id)
+        attr = capabilities_attr
+        current = attr["value"] or ()
+        missing = needed.difference(current)
+        if not missing:
+            return
+        log.info("Setting capabilities %s to resource %s", missing, resource_id)
+        # sorted, so that the stored value does not change between runs
+        attr["value"] = sorted(missing.union(current))
+        self._perun_call(
+            "attributesManager",
+            "setAttribute",
+            {"resource": resource_id, "attribute": attr},
+            idempotent=True,
+        )
+        log.info("Capabilities %s set to resource %s", missing, resource_id)
 
-    def attach_service_to_resource(self, resource_id: int, service_id: int) -> None:
+    def attach_service_to_resource(
+        self,
+        resource_id: int,
+        service_id: int,
+        assigned_services: list | None = None,
+    ) -> None:
         """Attach a service to a resource.
 
         :param resource_id:                 id of the resource
         :param service_id:                  id of the service to be attached
+        :param assigned_services:           services already assigned to the resource, fetched if not passed
         :return:
         """
         # assign sync service to the resource
-        services = self._perun_call(
-            "resourcesManager", "getAssignedServices", {"resource": resource_id}
-        )
-        for service in services:
-            if str(service["id"]) == str(service_id):
-                break
-        else:
-            log.info(
-                "Assigning service %s to resource %s",
-                service_id,
-                resource_id,
-            )
-            self._perun_call(
+        self._ensure_assigned(
+            items=assigned_services,
+            fetch=(
+                "resourcesManager",
+                "getAssignedServices",
+                {"resource": resource_id},
+            ),
+            target_id=service_id,
+            assign=(
                 "resourcesManager",
                 "assignService",
                 {"resource": resource_id, "service": service_id},
-            )
-            log.info(
-                "Service %s assigned to resource %s",
-                service_id,
-                resource_id,
-            )
+            ),
+            description=("service %s to resource %s", service_id, resource_id),
+        )
 
     def get_resource_by_name(
         self, vo_id: int, facility_id: int, name: str
@@ -401,66 +829,143 @@ class PerunLowLevelAPI:
         :param name:                name of the resource
         :return:                    resource or None if not found
         """
-        try:
-            return self._perun_call_dict(
-                "resourcesManager",
-                "getResourceByName",
-                {"vo": vo_id, "facility": facility_id, "name": name},
-            )
-        except DoesNotExist:
+        key = ("resource", vo_id, facility_id, name)
+        resource = self._get_cached_lookup(key)
+        if resource is not None:
+            return resource
+        # a missing resource is a common case when provisioning, so it is returned
+        # as None rather than raised and caught
+        ret = self._perun_call(
+            "resourcesManager",
+            "getResourceByName",
+            {"vo": vo_id, "facility": facility_id, "name": name},
+            ok_not_found=True,
+        )
+        if ret is None:
+            # not found is not cached, so that a freshly created resource is seen
             return None
+        assert isinstance(ret, dict)
+        self._cache_lookup(key, ret)
+        return dict(ret)
 
     def get_resource_by_capability(
-        self, *, vo_id: int, facility_id: int, capability: str
+        self,
+        *,
+        vo_id: int,
+        facility_id: int,
+        capability: str,
+        use_searcher: bool = False,
     ) -> Optional[dict]:
         """Get a resource by capability.
 
         :param vo_id:               id of the virtual organization
         :param facility_id:         id of the facility where we search for resource
         :param capability:          capability to search for
+        :param use_searcher:        if True, let the Perun searcher find the resources with
+                                    the capability instead of listing all resources of the
+                                    facility (see EINFRA_SEARCH_RESOURCES_BY_CAPABILITY)
 
         :return:                    resource or None if not found
         """
-        # Implementation 2: iterate all resources and filter
-        resources = self._perun_call(
-            "resourcesManager",
-            "getEnrichedResourcesForFacility",
-            {"facility": facility_id},
-        )
-        matching_resources = [
-            resource["resource"]
-            for resource in resources
-            if self._has_capability(resource, capability)
-        ]
-
-        # Implementation 1: searcher
-        # resources = self._perun_call(
-        #     "searcher",
-        #     "getResources",
-        #     {"attributesWithSearchingValues": {"capabilities": capability}},
-        # )
-        # matching_resources = [
-        #     resource
-        #     for resource in resources
-        #     if resource["voId"] == vo_id and resource["facilityId"] == facility_id
-        # ]
+        matching_resources: list[dict]
+        if use_searcher:
+            # let Perun do the filtering, so that only the matching resources are transferred
+            resources = self._perun_call(
+                "searcher",
+                "getResources",
+                {
+                    "attributesWithSearchingValues": {
+                        "urn:perun:resource:attribute-def:def:capabilities": capability
+                    }
+                },
+            )
+            matching_resources = [
+                resource
+                for resource in resources
+                if int(resource["voId"]) == int(vo_id)
+                and int(resource["facilityId"]) == int(facility_id)
+            ]
+        else:
+            resources = self._perun_call(
+                "resourcesManager",
+                "getEnrichedResourcesForFacility",
+                {"facility": facility_id},
+                conditional=True,
+            )
+            matching_resources = [
+                resource["resource"]
+                for resource in resources
+                if self._has_capability(resource, capability)
+            ]
         if not matching_resources:
             return None
         if len(matching_resources) > 1:
             raise ValueError(
                 f"More than one resource found for {capability}: {matching_resources}"
             )
-        return matching_resources[0]
+        # the resources might come from the shared response cache, so return a copy
+        return dict(matching_resources[0])
+
+    def get_resources_by_capabilities(
+        self,
+        *,
+        vo_id: int,
+        facility_id: int,
+        capabilities: list[str],
+        use_searcher: bool = False,
+    ) -> list[dict | None]:
+        """Get resources for several capabilities.
+
+        :param vo_id:               id of the virtual organization
+        :param facility_id:         id of the facility where we search for resources
+        :param capabilities:        capabilities to search for
+        :param use_searcher:        see get_resource_by_capability
+        :return:                    resource or None for each of the capabilities, in the same order
+        """
+
+        def lookup(capability: str) -> dict | None:
+            return self.get_resource_by_capability(
+                vo_id=vo_id,
+                facility_id=facility_id,
+                capability=capability,
+                use_searcher=use_searcher,
+            )
+
+        if use_searcher and len(capabilities) > 1:
+            # a separate search for each of the capabilities, run them concurrently
+            return list(self._worker_pool.map(lookup, capabilities))
+        # the resources of the facility are listed by the first lookup,
+        # the others reuse the (conditional) response
+        return [lookup(capability) for capability in capabilities]
 
     def _has_capability(self, resource: dict, capability: str) -> bool:
-        attributes = resource.get("attributes", [])
-        for attr in attributes:
-            if (
-                attr["namespace"] == "urn:perun:resource:attribute-def:def"
-                and attr["friendlyName"] == "capabilities"
-            ):
-                return capability in attr["value"]
-        return False
+        """Check if an enriched resource has the capability.
+
+        :param resource:        enriched resource (resource with its attributes)
+        :param capability:      capability to look for
+        """
+        resource_id = resource["resource"]["id"]
+        with self._lookup_cache_lock:
+            cached = self._attr_index_cache.get(resource_id)
+        # the index is valid as long as the (reused) enriched resource is the same object,
+        # so that the attributes are scanned only once per fetched response
+        if cached is None or cached[0] is not resource:
+            cached = (resource, self._index_attrs(resource))
+            with self._lookup_cache_lock:
+                self._attr_index_cache[resource_id] = cached
+        capabilities = cached[1].get(
+            ("urn:perun:resource:attribute-def:def", "capabilities")
+        )
+        return capability in (capabilities or ())
+
+    @staticmethod
+    def _index_attrs(resource: dict) -> dict[tuple[str, str], Any]:
+        """Index attribute values of an enriched resource by (namespace, friendlyName)."""
+        index: dict[tuple[str, str], Any] = {}
+        for attr in resource.get("attributes", ()):
+            # keep the first attribute if there are more with the same name, as before
+            index.setdefault((attr["namespace"], attr["friendlyName"]), attr["value"])
+        return index
 
     def get_resource_groups(self, *, resource_id: int) -> list[dict]:
         """Get groups assigned to a resource.
@@ -506,10 +1011,13 @@ class PerunLowLevelAPI:
 
         :param name:        name of the service
         """
-        return self._perun_call_dict(
-            "servicesManager",
-            "getServiceByName",
-            {"name": name},
+        return self._cached_lookup(
+            ("service", name),
+            lambda: self._perun_call_dict(
+                "servicesManager",
+                "getServiceByName",
+                {"name": name},
+            ),
         )
 
     def get_attribute_by_name(self, name: str) -> dict:
@@ -517,8 +1025,11 @@ class PerunLowLevelAPI:
 
         :param name:        name of the attribute
         """
-        return self._perun_call_dict(
-            "attributesManager", "getAttributeDefinition", {"attributeName": name}
+        return self._cached_lookup(
+            ("attribute", name),
+            lambda: self._perun_call_dict(
+                "attributesManager", "getAttributeDefinition", {"attributeName": name}
+            ),
         )
 
     def remove_user_from_group(
@@ -532,11 +1043,15 @@ class PerunLowLevelAPI:
         """
         member = self._get_or_create_member_in_vo(vo_id, user_id)
 
-        self._perun_call(
-            "groupsManager",
-            "removeMember",
-            {"group": group_id, "member": member["id"]},
-        )
+        try:
+            self._perun_call(
+                "groupsManager",
+                "removeMember",
+                {"group": group_id, "member": member["id"]},
+            )
+        except Exception:
+            self._invalidate_lookup(("member", vo_id, user_id))
+            raise
 
     def add_user_to_group(self, *, vo_id: int, user_id: int, group_id: int) -> None:
         """Add a user to a group.
@@ -545,20 +1060,43 @@ class PerunLowLevelAPI:
         :param user_id:           internal perun id of the user
         :param group_id:            id of the group
         """
+        self.add_user_to_groups(vo_id=vo_id, user_id=user_id, group_ids=[group_id])
+
+    def add_user_to_groups(
+        self, *, vo_id: int, user_id: int, group_ids: list[int]
+    ) -> None:
+        """Add a user to several groups, the groups are added concurrently.
+
+        :param vo_id:           id of the virtual organization
+        :param user_id:         internal perun id of the user
+        :param group_ids:       ids of the groups
+        """
         member = self._get_or_create_member_in_vo(vo_id, user_id)
 
-        self._perun_call(
-            "groupsManager",
-            "addMember",
-            {"group": group_id, "member": member["id"]},
-        )
+        try:
+            self._perun_call_many(
+                [
+                    (
+                        "groupsManager",
+                        "addMember",
+                        {"group": group_id, "member": member["id"]},
+                    )
+                    for group_id in group_ids
+                ]
+            )
+        except Exception:
+            self._invalidate_lookup(("member", vo_id, user_id))
+            raise
 
     def _get_or_create_member_in_vo(self, vo_id: int, user_id: int) -> dict:
         # TODO: create part here (but we might not need it if everything goes through invitations)
-        member = self._perun_call_dict(
-            "membersManager", "getMemberByUser", {"vo": vo_id, "user": user_id}
+        return self._cached_lookup(
+            ("member", vo_id, user_id),
+            lambda: self._perun_call_dict(
+                "membersManager", "getMemberByUser", {"vo": vo_id, "user": user_id}
+            ),
+            ttl=MEMBER_CACHE_TTL,
         )
-        return member
 
     def send_invitation(
         self,
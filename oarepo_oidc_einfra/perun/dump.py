@@ -10,17 +10,29 @@
 import dataclasses
 import logging
 from collections import defaultdict
+from collections.abc import Iterable
+from collections.abc import Set as AbstractSet
 from functools import cached_property
-from typing import Dict, Iterable, List, Set
+from typing import IO
 from uuid import UUID
 
+import ijson
+
 from oarepo_oidc_einfra.communities import CommunityRole
 from oarepo_oidc_einfra.proxies import current_einfra_oidc
 
 log = logging.getLogger("perun.dump_data")
 
+_NO_ROLES: frozenset[CommunityRole] = frozenset()
+
+_CAPABILITY_PREFIX = "res:communities:"
+"""Prefix of the capabilities of communities."""
+
+_CAPABILITY_PREFIX_LENGTH = len(_CAPABILITY_PREFIX)
+"""Length of the prefix, capabilities look like res:communities:<slug>:role:<role>."""
+
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class AAIUser:
     """A user with their roles as received from the Perun AAI."""
 
@@ -28,7 +40,7 @@ class AAIUser:
     email: str
     full_name: str
     organization: str
-    roles: Set[CommunityRole]
+    roles: AbstractSet[CommunityRole]
 
 
 class PerunDumpData:
@@ -37,8 +49,8 @@ class PerunDumpData:
     def __init__(
         self,
         dump_data: dict,
-        community_slug_to_id: Dict[str, UUID],
-        community_role_names: Set[str],
+        community_slug_to_id: dict[str, UUID],
+        community_role_names: AbstractSet[str],
     ):
         """Create an instance of the data.
 
@@ -49,25 +61,50 @@ class PerunDumpData:
         self.dump_data = dump_data
         self.slug_to_id = community_slug_to_id
         self.community_role_names = community_role_names
+        self._dump_stream: IO[bytes] | None = None
+        self._roles_by_resource_set: dict[frozenset[str], frozenset[CommunityRole]] = {}
+
+    @classmethod
+    def from_stream(
+        cls,
+        dump_stream: IO[bytes],
+        community_slug_to_id: dict[str, UUID],
+        community_role_names: AbstractSet[str],
+    ) -> "PerunDumpData":
+        """Create an instance of the data from a stream with the dump json.
+
+        Resources are parsed immediately as they are needed for every user, users are parsed
+        from the stream only when they are iterated, so that they are not all held in memory.
+        The stream must be seekable and must stay open while the users are iterated.
+
+        :param dump_stream:             seekable binary stream with the PERUN dump (json)
+        :param community_slug_to_id:    Mapping of community slugs to their ids (str of uuid)
+        :param community_role_names:    a set of known community role names
+        """
+        resources = dict(ijson.kvitems(dump_stream, "resources"))
+        ret = cls({"resources": resources}, community_slug_to_id, community_role_names)
+        ret._dump_stream = dump_stream
+        return ret
 
     @cached_property
-    def aai_community_roles(self) -> Set[CommunityRole]:
+    def aai_community_roles(self) -> set[CommunityRole]:
         """Return all community roles from the dump.
 
         :return: set of community roles known to perun
         """
-        aai_community_roles = set()
-        for resource_community_roles in self.resource_to_community_roles.values():
-            aai_community_roles.update(resource_community_roles)
-        return aai_community_roles
+        return set().union(*self.resource_to_community_roles.values())
 
     @cached_property
-    def resource_to_community_roles(self) -> Dict[str, List[CommunityRole]]:
+    def resource_to_community_roles(self) -> dict[str, frozenset[CommunityRole]]:
         """Returns a mapping of resource id to community roles.
 
         :return:    for each Perun resource, mapping to associated community roles
         """
-        resources = defaultdict(list)
+        resources: dict[str, set[CommunityRole]] = defaultdict(set)
+        # bind the lookups to locals, they are used for every capability in the dump
+        capabilities_attribute_name = current_einfra_oidc.capabilities_attribute_name
+        slug_to_id = self.slug_to_id
+        community_role_names = self.community_role_names
         for r_id, r in self.dump_data["resources"].items():
             # data look like
             # "0003a30a-5512-4ff1-ae1c-b13372041459" : {
@@ -77,69 +114,76 @@ class PerunDumpData:
             #       ]
             #   }
             # },
-            capabilities = r.get("attributes", {}).get(
-                current_einfra_oidc.capabilities_attribute_name, []
-            )
+            capabilities = r.get("attributes", {}).get(capabilities_attribute_name, [])
             for capability in capabilities:
-                parts = capability.split(":")
-                if (
-                    len(parts) == 5
-                    and parts[0] == "res"
-                    and parts[1] == "communities"
-                    and parts[3] == "role"
-                ):
-                    community_slug = parts[2]
-                    role = parts[4]
-                    if community_slug not in self.slug_to_id:
-                        log.error(
-                            f"Community from PERUN {community_slug} not found in the repository"
-                        )
-                        continue
-                    if role not in self.community_role_names:
-                        log.error(f"Role from PERUN {role} not found in the repository")
-                        continue
-                    community_role = CommunityRole(
-                        self.slug_to_id[community_slug], role
+                # most of the capabilities are not community ones, so check the prefix first
+                if not capability.startswith(_CAPABILITY_PREFIX):
+                    continue
+                parts = capability[_CAPABILITY_PREFIX_LENGTH:].split(":", 2)
+                if len(parts) != 3 or parts[1] != "role":
+                    continue
+                community_slug, _, role = parts
+                if not community_slug or not role or ":" in role:
+                    continue
+                community_id = slug_to_id.get(community_slug)
+                if community_id is None:
+                    log.error(
+                        "Community from PERUN %s not found in the repository",
+                        community_slug,
                     )
-                    resources[r_id].append(community_role)
+                    continue
+                if role not in community_role_names:
+                    log.error("Role from PERUN %s not found in the repository", role)
+                    continue
+                resources[r_id].add(CommunityRole(community_id, role))
 
-        return resources
+        # frozen once, so that the roles of users are plain unions of these
+        return {r_id: frozenset(roles) for r_id, roles in resources.items()}
 
     def users(self) -> Iterable[AAIUser]:
         """Return all users from the dump.
 
         :return: iterable of AAIUser
         """
-        for u in self.dump_data["users"].values():
-            einfra_id = u["attributes"].get(
-                current_einfra_oidc.einfra_user_id_dump_attribute,
-            )
-            full_name = u["attributes"].get(
-                current_einfra_oidc.user_display_name_attribute
-            )
-            organization = u["attributes"].get(
-                current_einfra_oidc.user_organization_attribute
-            )
-            email = u["attributes"].get(
-                current_einfra_oidc.user_preferred_mail_attribute
-            )
+        # bind the attribute names to locals, reading them through the proxy
+        # for every user is measurable on large dumps
+        einfra_id_attribute = current_einfra_oidc.einfra_user_id_dump_attribute
+        full_name_attribute = current_einfra_oidc.user_display_name_attribute
+        organization_attribute = current_einfra_oidc.user_organization_attribute
+        email_attribute = current_einfra_oidc.user_preferred_mail_attribute
+        get_roles_for_resources = self._get_roles_for_resources
+        for u in self._user_records():
+            attributes = u["attributes"]
             yield AAIUser(
-                einfra_id=einfra_id,
-                email=email,
-                full_name=full_name,
-                organization=organization,
-                roles=self._get_roles_for_resources(u.get("allowed_resources", {})),
+                attributes.get(einfra_id_attribute),
+                attributes.get(email_attribute),
+                attributes.get(full_name_attribute),
+                attributes.get(organization_attribute),
+                get_roles_for_resources(u.get("allowed_resources", {})),
             )
 
+    def _user_records(self) -> Iterable[dict]:
+        """Return the raw user records from the dump."""
+        if self._dump_stream is None:
+            return self.dump_data["users"].values()
+        self._dump_stream.seek(0)
+        return (u for _, u in ijson.kvitems(self._dump_stream, "users"))
+
     def _get_roles_for_resources(
         self, allowed_resources: Iterable[str]
-    ) -> Set[CommunityRole]:
+    ) -> frozenset[CommunityRole]:
         """Return community roles for an iterable of allowed resources.
 
         :param allowed_resources:       iterable of resource ids
         :return:                        a set of associated community roles
         """
-        aai_communities = set()
-        for resource in allowed_resources:
-            aai_communities.update(self.resource_to_community_roles.get(resource, []))
-        return aai_communities
+        # users of the same communities share the same sets of resources,
+        # so the union is computed only once for each distinct set
+        resource_set = frozenset(allowed_resources)
+        roles = self._roles_by_resource_set.get(resource_set)
+        if roles is None:
+            resource_to_community_roles = self.resource_to_community_roles
+            roles = self._roles_by_resource_set[resource_set] = _NO_ROLES.union(
+                *(resource_to_community_roles.get(r, _NO_ROLES) for r in resource_set)
+            )
+        return roles
@@ -12,7 +12,12 @@ from typing import Set
 
 from urnparse import URN8141, InvalidURNFormatError
 
-from ..communities import CommunityRole, CommunitySupport
+from ..communities import (
+    CommunityRole,
+    CommunitySupport,
+    clear_community_cache,
+    get_slug_to_id,
+)
 from ..proxies import current_einfra_oidc
 from .mapping import SlugCommunityRole, get_invenio_role_from_capability
 
@@ -25,11 +30,13 @@ def get_communities_from_userinfo_token(userinfo_token: dict) -> Set[CommunityRo
     :param userinfo_token:          userinfo token from perun/oidc server
     :return:                        a set of community roles associated with the user
     """
-    cs = CommunitySupport()
+    slug_to_id = get_slug_to_id()
 
-    slug_to_id = cs.slug_to_id
+    community_roles = CommunitySupport().role_names
 
-    community_roles = cs.role_names
+    # resolve the extension proxy once, not for every entitlement
+    entitlement_namespaces = current_einfra_oidc.entitlement_namespaces
+    entitlement_prefix = current_einfra_oidc.entitlement_prefix
 
     # Entitlement looks like:
     # 1 = {str} 'urn:geant:cesnet.cz:res:communities:cuni:role:curator#perun.cesnet.cz'
@@ -41,10 +48,10 @@ def get_communities_from_userinfo_token(userinfo_token: dict) -> Set[CommunityRo
         except InvalidURNFormatError:
             # not a valid URN, skipping
             continue
-        if urn.namespace_id.value not in current_einfra_oidc.entitlement_namespaces:
+        if urn.namespace_id.value not in entitlement_namespaces:
             continue
         parts = urn.specific_string.parts
-        if not parts or parts[0] != current_einfra_oidc.entitlement_prefix:
+        if not parts or parts[0] != entitlement_prefix:
             continue
         try:
             slug_role: SlugCommunityRole = get_invenio_role_from_capability(parts[1:])
@@ -53,6 +60,16 @@ def get_communities_from_userinfo_token(userinfo_token: dict) -> Set[CommunityRo
                     f"Role {slug_role.role} not found in community roles in urn {urn}"
                 )
                 continue
+            if slug_role.slug not in slug_to_id:
+                # the community might have been created in another process after
+                # the mapping has been cached, so reload it
+                clear_community_cache()
+                slug_to_id = get_slug_to_id()
+            if slug_role.slug not in slug_to_id:
+                log.error(
+                    f"Community {slug_role.slug} not found in the repository in urn {urn}"
+                )
+                continue
             aai_groups.add(CommunityRole(slug_to_id[slug_role.slug], slug_role.role))
         except ValueError:
             continue
@@ -8,11 +8,16 @@
 """E-Infra OIDC Remote Auth backend for NRP."""
 
 import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from typing import cast
 
 import jwt
 from flask_oauthlib.client import OAuthRemoteApp
 from invenio_accounts.models import User, UserIdentity
+from invenio_cache.proxies import current_cache
 from invenio_db import db
 from invenio_oauthclient import current_oauthclient
 from invenio_oauthclient.contrib.settings import OAuthSettingsHelper
@@ -21,6 +26,8 @@ from invenio_oauthclient.models import RemoteToken
 from invenio_oauthclient.oauth import oauth_get_user
 from invenio_oauthclient.signals import account_info_received
 
+from .config import get_rsa_public_key
+
 
 class EInfraOAuthSettingsHelper(OAuthSettingsHelper):
     """E-Infra OIDC Remote Auth backend for NRP."""
@@ -120,22 +127,82 @@ CESNET OpenID remote app.
 EINFRA_LOGIN_APP = _cesnet_app.remote_app
 
 
-def account_info_serializer(remote: OAuthRemoteApp, resp: dict) -> dict:
-    """Serialize the account info response object.
+_verified_tokens: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+"""In-process LRU cache of verified id tokens, hash of token -> (payload, expiration)."""
 
-    :param remote: The remote application.
-    :param resp: The response of the `authorized` endpoint.
+_verified_tokens_lock = threading.Lock()
 
-    :returns: A dictionary with serialized user information.
+VERIFIED_TOKENS_MAXSIZE = 1024
+"""Maximum number of verified id tokens kept in the in-process cache."""
+
+
+def decode_id_token(remote: OAuthRemoteApp, id_token: str) -> dict:
+    """Verify the signature of the id token and return its payload.
+
+    The id token is decoded several times during a single login, so successfully
+    verified tokens are cached until they expire, both in this process and in the shared
+    invenio cache. The cache key is a hash of the whole token including its signature,
+    the token itself is not stored. Invalid tokens are never cached.
+
+    :param remote:      The remote application.
+    :param id_token:    The encoded id token.
+    :return:            The decoded payload of the token.
     """
+    cache_key = (
+        "EINFRA_ID_TOKEN_"
+        + hashlib.sha256(f"{remote.consumer_key}:{id_token}".encode()).hexdigest()
+    )
+    with _verified_tokens_lock:
+        cached = _verified_tokens.get(cache_key)
+        if cached is not None:
+            if cached[1] > time.time():
+                _verified_tokens.move_to_end(cache_key)
+                # callers might modify the payload, so do not give them the cached one
+                return dict(cached[0])
+            del _verified_tokens[cache_key]
+
+    decoded_token = current_cache.cache.get(cache_key)
+    if decoded_token is not None:
+        _remember_verified_token(cache_key, decoded_token)
+        return decoded_token
+
     decoded_token = jwt.decode(
-        resp["id_token"],
+        id_token,
         options={"verify_signature": True},
-        key=remote.rsa_key,  # type: ignore
+        key=get_rsa_public_key(remote.rsa_key),  # type: ignore
         audience=remote.consumer_key,  # type: ignore
         algorithms=["RS256"],
     )
 
+    if "exp" in decoded_token:
+        timeout = int(decoded_token["exp"] - time.time())
+        if timeout > 0:
+            current_cache.cache.set(cache_key, decoded_token, timeout=timeout)
+            _remember_verified_token(cache_key, decoded_token)
+    return decoded_token
+
+
+def _remember_verified_token(cache_key: str, decoded_token: dict) -> None:
+    """Put a verified token to the in-process cache, evicting the least recently used ones."""
+    if "exp" not in decoded_token:
+        return
+    with _verified_tokens_lock:
+        _verified_tokens[cache_key] = (dict(decoded_token), decoded_token["exp"])
+        _verified_tokens.move_to_end(cache_key)
+        while len(_verified_tokens) > VERIFIED_TOKENS_MAXSIZE:
+            _verified_tokens.popitem(last=False)
+
+
+def account_info_serializer(remote: OAuthRemoteApp, resp: dict) -> dict:
+    """Serialize the account info response object.
+
+    :param remote: The remote application.
+    :param resp: The response of the `authorized` endpoint.
+
+    :returns: A dictionary with serialized user information.
+    """
+    decoded_token = decode_id_token(remote, resp["id_token"])
+
     return {
         "external_id": decoded_token["sub"],
         "external_method": remote.name,
@@ -180,13 +247,7 @@ def account_setup(remote: OAuthRemoteApp, token: RemoteToken, resp: dict) -> Non
     :param token: The token value.
     :param resp: The response.
     """
-    decoded_token = jwt.decode(
-        resp["id_token"],
-        options={"verify_signature": True},
-        algorithms=["RS256"],
-        key=remote.rsa_key,  # type: ignore
-        audience=remote.consumer_key,  # type: ignore
-    )
+    decoded_token = decode_id_token(remote, resp["id_token"])
 
     with db.session.begin_nested():  # type: ignore
         token.remote_account.extra_data = {
@@ -13,7 +13,8 @@ from __future__ import annotations
 import hashlib
 import logging
 from datetime import UTC, datetime
-from typing import TYPE_CHECKING, Optional
+from functools import lru_cache
+from typing import IO, TYPE_CHECKING, Optional
 
 from flask import Blueprint, Flask, g, redirect, request
 from flask_login import fresh_login_required, login_required, logout_user
@@ -34,6 +35,7 @@ from oarepo_oidc_einfra.proxies import current_einfra_oidc
 from oarepo_oidc_einfra.tasks import update_from_perun_dump
 
 if TYPE_CHECKING:
+    from boto3.s3.transfer import TransferConfig
     from werkzeug import Response
 
 log = logging.getLogger(__name__)
@@ -42,6 +44,22 @@ log = logging.getLogger(__name__)
 upload_dump_action = action_factory("upload-oidc-einfra-dump")
 
 
+@lru_cache(maxsize=1)
+def dump_transfer_config() -> TransferConfig:
+    """S3 transfer configuration used when uploading the dumps (multipart, parallel upload).
+
+    Created on first use, so that boto3 is not imported when the application starts.
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=8 * 1024 * 1024,
+        max_concurrency=16,
+        use_threads=True,
+    )
+
+
 class OIDCEInfraUIResourceConfig(ResourceConfig):
     """Configuration for the REST API."""
 
@@ -203,33 +221,68 @@ class OIDCEInfraAPIResource(Resource):
                 "message": "Content-Type must be application/json",
             }, 400
 
-        dump_path, checksum = store_dump(request.data)
+        dump_path, checksum = store_dump(request.stream)
         update_from_perun_dump.delay(dump_path, checksum)
         return {"status": "ok"}, 201
 
 
-def store_dump(request_data: bytes) -> tuple[str, str]:
+class _ChecksumReader:
+    """Read-only wrapper around a file-like object computing sha-256 of the data read.
+
+    The wrapper intentionally does not provide seek/tell, so that boto3 reads
+    the underlying stream sequentially and the checksum is computed in the order
+    in which the data are sent to S3.
+    """
+
+    def __init__(self, fileobj: IO[bytes]):
+        """Create the wrapper.
+
+        :param fileobj:     the wrapped file-like object
+        """
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read data from the wrapped object and update the checksum."""
+        data = self._fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        """Return the sha-256 checksum of the data read so far."""
+        return self._hash.hexdigest()
+
+
+def store_dump(dump_file: IO[bytes]) -> tuple[str, str]:
     """Store the dump in the configured location and return the path.
 
     The dump is stored in the bucket configured in the EINFRA_USER_DUMP_S3_BUCKET,
     the actual path is put into the cache under the key EINFRA_LAST_DUMP_PATH
     and the path is returned.
 
+    The dump is streamed to S3 (multipart upload), so it is never held in memory as a whole.
+    The checksum is computed incrementally while the data are being uploaded.
+
     Storing the path into the cache means that even if the background task process
     multiple dumps out of order, the last one will be always the one that is processed -
     the previous ones will be ignored.
+
+    :param dump_file:   a binary file-like object with the dump
+    :return:            (path of the dump inside the bucket, sha-256 checksum of the dump)
     """
     now = datetime.now(UTC).strftime("%Y-%m-%d-%H-%M-%S")
     dump_path = f"{now}.json"
     client = current_einfra_oidc.dump_boto3_client
-    client.put_object(
+    reader = _ChecksumReader(dump_file)
+    client.upload_fileobj(
+        reader,
         Bucket=current_einfra_oidc.dump_s3_bucket,
         Key=dump_path,
-        Body=request_data,
+        Config=dump_transfer_config(),
     )
     current_cache.cache.set("EINFRA_LAST_DUMP_PATH", dump_path)
 
-    return dump_path, hashlib.sha256(request_data).hexdigest()
+    return dump_path, reader.hexdigest()
 
 
 def create_ui_blueprint(app: Flask) -> Blueprint:
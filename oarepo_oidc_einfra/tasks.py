@@ -13,8 +13,9 @@ import hashlib
 import json
 import logging
 from datetime import date, timedelta
-from io import BytesIO
+from functools import lru_cache
 from itertools import chain, islice
+from tempfile import TemporaryFile
 from typing import TYPE_CHECKING, Iterable, Literal
 
 from celery import shared_task
@@ -25,8 +26,14 @@ from invenio_communities.communities.records.api import Community
 from invenio_communities.members.records.api import Member
 from invenio_db import db
 from invenio_requests.records.api import Request
+from sqlalchemy import select
 
-from oarepo_oidc_einfra.communities import CommunityRole, CommunitySupport
+from oarepo_oidc_einfra.communities import (
+    CommunityRole,
+    CommunitySupport,
+    get_all_community_roles,
+    get_slug_to_id,
+)
 from oarepo_oidc_einfra.encryption import encrypt
 from oarepo_oidc_einfra.mutex import mutex
 from oarepo_oidc_einfra.perun.dump import PerunDumpData
@@ -40,20 +47,46 @@ from oarepo_oidc_einfra.proxies import current_einfra_oidc
 if TYPE_CHECKING:
     from uuid import UUID
 
+    from boto3.s3.transfer import TransferConfig
+
     from oarepo_oidc_einfra.perun import PerunLowLevelAPI
 
 log = logging.getLogger("PerunSynchronizationTask")
 
+DUMP_CHUNK_SIZE = 8 * 1024 * 1024
+"""Size of the chunks in which the dump is downloaded and its checksum computed."""
+
+
+@lru_cache(maxsize=1)
+def dump_download_config() -> TransferConfig:
+    """S3 transfer configuration used when downloading the dumps (parallel ranged downloads).
+
+    Created on first use, so that boto3 is not imported when the module is loaded.
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=DUMP_CHUNK_SIZE,
+        multipart_chunksize=DUMP_CHUNK_SIZE,
+        max_concurrency=4,
+        use_threads=True,
+    )
+
 
 @shared_task
 @mutex("EINFRA_SYNC_MUTEX")
-def synchronize_community_to_perun(community_id: str) -> None:
+def synchronize_community_to_perun(
+    community_id: str, skip_unchanged: bool = False
+) -> None:
     """Synchronize community into Perun groups and resources.
 
     The call is idempotent, if the perun mapping already exists,
     it is left untouched.
 
     :param community_id:        id of the community
+    :param skip_unchanged:      do not call perun if the community has been synchronized
+                                during the last EINFRA_COMMUNITY_SYNC_CACHE_TIMEOUT seconds
+                                and the synchronized data have not changed since then
 
     Structure inside Perun
 
@@ -72,6 +105,12 @@ def synchronize_community_to_perun(community_id: str) -> None:
     slug = community.slug
     roles = current_app.config["COMMUNITIES_ROLES"]
 
+    fingerprint_key = f"EINFRA_COMMUNITY_SYNC_{community_id}"
+    fingerprint = community_sync_fingerprint(community)
+    if skip_unchanged and current_cache.cache.get(fingerprint_key) == fingerprint:
+        log.info("Community %s has not changed since the last sync, skipping", slug)
+        return
+
     api = current_einfra_oidc.perun_api()
 
     group, resource = map_community_or_role(
@@ -102,6 +141,31 @@ def synchronize_community_to_perun(community_id: str) -> None:
             resource_capabilities=[f"res:communities:{slug}:role:{role_name}"],
         )
 
+    current_cache.cache.set(
+        fingerprint_key,
+        fingerprint,
+        timeout=current_app.config["EINFRA_COMMUNITY_SYNC_CACHE_TIMEOUT"],
+    )
+
+
+def community_sync_fingerprint(community: Community) -> str:
+    """Return a hash of the community data that are synchronized to perun.
+
+    :param community:       community record
+    :return:                hex digest of the synchronized data
+    """
+    payload = {
+        "slug": community.slug,
+        "description": community.metadata.get("description"),  # type: ignore
+        "roles": [role["name"] for role in current_app.config["COMMUNITIES_ROLES"]],
+        "vo": current_einfra_oidc.repository_vo_id,
+        "facility": current_einfra_oidc.repository_facility_id,
+        "group": current_einfra_oidc.communities_group_id,
+    }
+    return hashlib.blake2b(
+        json.dumps(payload, sort_keys=True).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
 
 def map_community_or_role(
     api: PerunLowLevelAPI,
@@ -150,10 +214,17 @@ def map_community_or_role(
 
 
 @shared_task
-def synchronize_all_communities_to_perun() -> None:
-    """Check and repair community mapping within perun."""
-    for community_model in Community.model_cls.query.all():
-        synchronize_community_to_perun(str(community_model.id))
+def synchronize_all_communities_to_perun(skip_unchanged: bool = False) -> None:
+    """Check and repair community mapping within perun.
+
+    :param skip_unchanged:  skip communities that have not changed since their last synchronization
+    """
+    # fetch all the ids first, so that no cursor is kept open while talking to perun
+    community_ids = (
+        db.session.execute(select(Community.model_cls.id)).scalars().all()  # type: ignore
+    )
+    for community_id in community_ids:
+        synchronize_community_to_perun(str(community_id), skip_unchanged=skip_unchanged)
 
 
 @shared_task
@@ -184,37 +255,44 @@ def update_from_perun_dump(
             return
     client = current_einfra_oidc.dump_boto3_client
 
-    with BytesIO() as obj:
+    with TemporaryFile() as obj:
+        # download the dump with several ranged requests in parallel,
+        # then compute the checksum from the local copy
         client.download_fileobj(
             Bucket=current_einfra_oidc.dump_s3_bucket,
             Key=dump_path,
             Fileobj=obj,
+            Config=dump_download_config(),
         )
         obj.seek(0)
-        value = obj.getvalue()
-        if checksum is not None:
-            value_checksum = hashlib.sha256(value).hexdigest()
-            if value_checksum != checksum:
-                log.error(
-                    "Checksum of the downloaded dump does not match the expected checksum."
-                )
-                return
-        data = json.loads(value.decode("utf-8"))
-    community_support = CommunitySupport()
-    dump = PerunDumpData(
-        data, community_support.slug_to_id, community_support.role_names
-    )
-
-    if fix_communities_in_perun:
-        synchronize_communities_to_perun(
-            community_support.all_community_roles, dump.aai_community_roles
+        value_checksum = hashlib.sha256()
+        while chunk := obj.read(DUMP_CHUNK_SIZE):
+            value_checksum.update(chunk)
+        if checksum is not None and value_checksum.hexdigest() != checksum:
+            log.error(
+                "Checksum of the downloaded dump does not match the expected checksum."
+            )
+            return
+        obj.seek(0)
+        # the users are streamed from the downloaded file, not loaded into memory at once
+        community_support = CommunitySupport()
+        # load the communities from the database once per task instead of using the
+        # process cache - a community created in another process within the cache timeout
+        # would be missing from the mapping and its members would be removed
+        dump = PerunDumpData.from_stream(
+            obj, get_slug_to_id(refresh=True), community_support.role_names
         )
 
-    synchronize_users_from_perun(dump, community_support)
+        if fix_communities_in_perun:
+            synchronize_communities_to_perun(
+                get_all_community_roles(refresh=True), dump.aai_community_roles
+            )
+
+        synchronize_users_from_perun(dump, community_support)
 
 
 def synchronize_communities_to_perun(
-    repository_community_roles: set[CommunityRole],
+    repository_community_roles: frozenset[CommunityRole],
     aai_community_roles: set[CommunityRole],
 ) -> None:
     """Synchronize communities to perun if they do not exist in perun yet.
@@ -222,14 +300,14 @@ def synchronize_communities_to_perun(
     :param repository_community_roles:   set of community roles from the repository
     :param aai_community_roles:          set of community roles from the perun dump
     """
-    if repository_community_roles - aai_community_roles:
+    unmapped_community_roles = repository_community_roles - aai_community_roles
+    if unmapped_community_roles:
         log.info(
-            "Some community roles are not mapped "
-            f"to any resource: {repository_community_roles - aai_community_roles}"
+            "Some community roles are not mapped to any resource: %s",
+            unmapped_community_roles,
         )
         communities_not_in_perun = {
-            str(cr.community_id)
-            for cr in repository_community_roles - aai_community_roles
+            str(cr.community_id) for cr in unmapped_community_roles
         }
         for community_id in communities_not_in_perun:
             synchronize_community_to_perun(community_id)
@@ -282,7 +360,7 @@ def synchronize_users_from_perun(
 
         for user in local_users:
             aai_user = aai_user_chunk_by_einfra_id[local_user_id_to_einfra_id[user.id]]
-            log.info("Setting user %s with roles %s", user, aai_user.roles)
+            log.debug("Setting user %s with roles %s", user, aai_user.roles)
             update_user_metadata(
                 user, aai_user.full_name, aai_user.email, aai_user.organization
             )
@@ -299,19 +377,33 @@ def synchronize_users_from_perun(
                 ),
             )
 
-        for unknown_user in set(aai_user_chunk_by_einfra_id.keys()) - set(
+        unknown_users = set(aai_user_chunk_by_einfra_id.keys()) - set(
             local_user_id_to_einfra_id.values()
-        ):
-            log.info(
-                "User with einfra id %s not yet found in the local database",
-                unknown_user,
-            )
+        )
+        if unknown_users:
+            log.info("%s users not yet found in the local database", len(unknown_users))
+            log.debug("Users with einfra ids %s not yet found", unknown_users)
 
     # for users that are not in the dump anymore, remove all communities
-    for local_user_id in local_users_by_einfra.values():
-        user = User.query.filter_by(id=local_user_id).one()
-        log.info("Removing obsolete user %s", user)
-        community_support.set_user_community_membership(user, set())
+    for local_user_id_chunk in chunks(local_users_by_einfra.values(), 1000):
+        local_user_ids = list(local_user_id_chunk)
+        local_community_roles_by_user_id = (
+            community_support.get_user_list_community_membership(local_user_ids)
+        )
+        obsolete_users = (
+            db.session.query(User)  # type: ignore
+            .filter(User.id.in_(local_user_ids))
+            .all()
+        )
+        for user in obsolete_users:
+            current_community_roles = local_community_roles_by_user_id.get(user.id)
+            if not current_community_roles:
+                # not a member of any community, nothing to remove
+                continue
+            log.info("Removing obsolete user %s", user)
+            community_support.set_user_community_membership(
+                user, set(), current_community_roles=current_community_roles
+            )
 
 
 def filter_community_roles(
@@ -322,16 +414,18 @@ def filter_community_roles(
     :param community_support:    community support object
     :param aai_roles:            an iterable community roles
     """
+    # role_priorities is computed once per community support object and shared
+    # by all the users in the dump
+    role_priorities = community_support.role_priorities
+
     new_community_roles: dict[UUID, CommunityRole] = {}
+    new_community_priorities: dict[UUID, int] = {}
 
     for community_role in aai_roles:
-        if community_role.community_id not in new_community_roles or (
-            community_support.role_priority(community_role.role)
-            > community_support.role_priority(
-                new_community_roles[community_role.community_id].role
-            )
-        ):
+        priority = role_priorities[community_role.role]
+        if priority > new_community_priorities.get(community_role.community_id, -1):
             new_community_roles[community_role.community_id] = community_role
+            new_community_priorities[community_role.community_id] = priority
     return set(new_community_roles.values())
 
 
@@ -388,6 +482,7 @@ def create_aai_invitation(request_id: str) -> dict | None:
         vo_id=current_einfra_oidc.repository_vo_id,
         facility_id=current_einfra_oidc.repository_facility_id,
         capability=capability,
+        use_searcher=current_einfra_oidc.search_resources_by_capability,
     )
     if not resource:
         raise ValueError(
@@ -461,8 +556,12 @@ def remove_aai_user_from_community(community_slug: str, user_id: int) -> None:
     :param community_slug:  community slug
     :param user_id:         user id
     """
-    for role in CommunitySupport().role_names:
-        aai_group_op("remove_user_from_group", community_slug, user_id, role)
+    aai_group_ops(
+        "remove_user_from_group",
+        community_slug,
+        user_id,
+        CommunitySupport().role_names,
+    )
 
 
 @shared_task
@@ -489,26 +588,34 @@ def aai_group_op(
     :param user_id:         user id
     :param role:            role name
     """
+    aai_group_ops(op, community_slug, user_id, [role])
+
+
+def aai_group_ops(
+    op: Literal["add_user_to_group", "remove_user_from_group"],
+    community_slug: str,
+    user_id: int,
+    roles: Iterable[str],
+) -> None:
+    """Add/remove user from groups of several community roles in AAI.
+
+    The user is looked up in Perun only once and the resources of the roles
+    are looked up concurrently.
+
+    :param op:              operation to perform (add_user_to_group, remove_user_from_group)
+    :param community_slug:  community slug
+    :param user_id:         user id
+    :param roles:           role names
+    """
     perun_api = current_einfra_oidc.perun_api()
+    vo_id = current_einfra_oidc.repository_vo_id
+    facility_id = current_einfra_oidc.repository_facility_id
 
     einfra_id = get_user_einfra_id(user_id)
     if not einfra_id:
         # nothing to synchronize as the user has no einfra identity
         return
 
-    # 1. find resource by capability
-    resource = perun_api.get_resource_by_capability(
-        vo_id=current_einfra_oidc.repository_vo_id,
-        facility_id=current_einfra_oidc.repository_facility_id,
-        capability=get_perun_capability_from_invenio_role(community_slug, role),
-    )
-    if resource is None:
-        log.error(
-            f"Resource for {community_slug} and role {role} not found inside Perun, "
-            f"so can not remove user from its associated group."
-        )
-        return
-
     user = perun_api.get_user_by_attribute(
         attribute_name=current_einfra_oidc.einfra_user_id_search_attribute,
         attribute_value=einfra_id,
@@ -520,13 +627,38 @@ def aai_group_op(
         )
         return
 
-    # 2. for each group, perform the operation on it
-    for group in perun_api.get_resource_groups(resource_id=resource["id"]):
-        try:
-            getattr(perun_api, op)(
-                vo_id=current_einfra_oidc.repository_vo_id,
-                user_id=user["id"],
-                group_id=group["id"],
+    # 1. find resources by capability
+    roles = list(roles)
+    resources = perun_api.get_resources_by_capabilities(
+        vo_id=vo_id,
+        facility_id=facility_id,
+        capabilities=[
+            get_perun_capability_from_invenio_role(community_slug, role)
+            for role in roles
+        ],
+        use_searcher=current_einfra_oidc.search_resources_by_capability,
+    )
+
+    for role, resource in zip(roles, resources, strict=True):
+        if resource is None:
+            log.error(
+                f"Resource for {community_slug} and role {role} not found inside Perun, "
+                f"so can not remove user from its associated group."
             )
-        except:
-            log.error(f"Error while performing {op} on group {group} for user {user}")
+            continue
+
+        # 2. for each group, perform the operation on it
+        for group in perun_api.get_resource_groups(resource_id=resource["id"]):
+            try:
+                getattr(perun_api, op)(
+                    vo_id=vo_id,
+                    user_id=user["id"],
+                    group_id=group["id"],
+                )
+            except Exception:
+                log.exception(
+                    "Error while performing %s on group %s for user %s",
+                    op,
+                    group,
+                    user,
+                )
@@ -0,0 +1,72 @@
+#
+# Copyright (C) 2024 CESNET z.s.p.o.
+#
+# oarepo-oidc-einfra  is free software; you can redistribute it and/or
+# modify it under the terms of the MIT License; see LICENSE file for more
+# details.
+#
+from pathlib import Path
+
+from invenio_accounts.models import User, UserIdentity
+
+from oarepo_oidc_einfra.cli import (
+    _bulk_add_einfra_users,
+    _dump_einfra_users,
+    _import_user_batch,
+)
+
+
+def test_dump_einfra_users():
+    pth = Path(__file__).parent / "dump_data" / "1.json"
+    with pth.open("rb") as f:
+        assert list(_dump_einfra_users(f)) == [
+            ("Miroslav.Simek@cesnet.cz", "user1@einfra.cesnet.cz")
+        ]
+
+
+def test_bulk_import_existing_identity(app, db):
+    linked = User(email="linked@test.com", active=True, password="1234")
+    not_linked = User(email="notlinked@test.com", active=True, password="1234")
+    db.session.add(linked)
+    db.session.add(not_linked)
+    db.session.commit()
+    UserIdentity.create(user=linked, method="e-infra", external_id="linked@einfra")
+    db.session.commit()
+
+    _bulk_add_einfra_users(
+        [
+            ("Linked@test.com", "linked@einfra"),
+            ("notlinked@test.com", "notlinked@einfra"),
+            ("new@test.com", "new@einfra"),
+        ]
+    )
+
+    # the already linked identity is kept as it was
+    assert (
+        UserIdentity.query.filter_by(method="e-infra", id="linked@einfra").one().id_user
+        == linked.id
+    )
+    # existing user gets linked, missing user is created and linked
+    assert (
+        UserIdentity.query.filter_by(method="e-infra", id="notlinked@einfra")
+        .one()
+        .id_user
+        == not_linked.id
+    )
+    new_user = User.query.filter_by(email="new@test.com").one()
+    assert (
+        UserIdentity.query.filter_by(method="e-infra", id="new@einfra").one().id_user
+        == new_user.id
+    )
+
+    # importing the same batch again (as another worker would) does not fail
+    # nor create duplicates
+    _import_user_batch(
+        app,
+        [
+            ("linked@test.com", "linked@einfra"),
+            ("new@test.com", "new@einfra"),
+        ],
+    )
+    assert User.query.filter_by(email="new@test.com").count() == 1
+    assert UserIdentity.query.filter_by(method="e-infra").count() == 3
@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2024 CESNET z.s.p.o.
+#
+# oarepo-oidc-einfra  is free software; you can redistribute it and/or
+# modify it under the terms of the MIT License; see LICENSE file for more
+# details.
+#
+from uuid import UUID
+
+from invenio_access.permissions import system_identity
+from invenio_communities import current_communities
+from invenio_communities.communities.records.api import Community
+from sqlalchemy import event
+
+from oarepo_oidc_einfra.communities import (
+    CommunityRole,
+    clear_community_cache,
+    get_all_community_roles,
+    get_slug_to_id,
+)
+
+
+def test_community_cache_invalidated_on_insert(app, db, location, search_clear):
+    # fill the cache before the community exists
+    assert "CUNI" not in get_slug_to_id()
+    roles_before = get_all_community_roles()
+
+    community = current_communities.service.create(
+        system_identity,
+        {
+            "slug": "CUNI",
+            "metadata": {
+                "title": "Charles University",
+                "description": "Charles university members",
+            },
+            "access": {"visibility": "public"},
+        },
+    )
+
+    # the insert has cleared the cache, so the new community is seen immediately
+    community_id = UUID(community.id)
+    assert get_slug_to_id()["CUNI"] == community_id
+    assert get_all_community_roles() == roles_before | {
+        CommunityRole(community_id, "curator"),
+        CommunityRole(community_id, "member"),
+    }
+
+
+def test_community_cache_refresh(app, db, location, search_clear):
+    assert "MUNI" not in get_slug_to_id()
+
+    # simulate a community created by another process - this process' cache
+    # is not invalidated by the insert
+    event.remove(Community.model_cls, "after_insert", clear_community_cache)
+    try:
+        community = current_communities.service.create(
+            system_identity,
+            {
+                "slug": "MUNI",
+                "metadata": {"title": "Masaryk University"},
+                "access": {"visibility": "public"},
+            },
+        )
+    finally:
+        event.listen(Community.model_cls, "after_insert", clear_community_cache)
+    assert "MUNI" not in get_slug_to_id()
+
+    # refresh reads the database and stores the fresh value in the cache
+    community_id = UUID(community.id)
+    assert get_slug_to_id(refresh=True)["MUNI"] == community_id
+    assert get_slug_to_id()["MUNI"] == community_id
+    assert CommunityRole(community_id, "member") in get_all_community_roles(
+        refresh=True
+    )
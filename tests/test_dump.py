@@ -0,0 +1,94 @@
+#
+# Copyright (C) 2024 CESNET z.s.p.o.
+#
+# oarepo-oidc-einfra  is free software; you can redistribute it and/or
+# modify it under the terms of the MIT License; see LICENSE file for more
+# details.
+#
+import io
+import json
+import uuid
+
+from oarepo_oidc_einfra.communities import CommunityRole
+from oarepo_oidc_einfra.perun.dump import AAIUser, PerunDumpData
+
+CAPABILITIES = "urn:perun:resource:attribute-def:def:capabilities"
+
+dump = {
+    "resources": {
+        "r1": {
+            "attributes": {
+                CAPABILITIES: [
+                    "res:testing_nrp_devel",
+                    "res:communities:CUNI",
+                    "res:communities:CUNI:role:curator",
+                ]
+            }
+        },
+        "r2": {
+            "attributes": {
+                CAPABILITIES: [
+                    "res:communities:CUNI:role:member",
+                    # malformed or unknown capabilities are ignored
+                    "res:communities:CUNI:role:member:extra",
+                    "res:communities:CUNI:role:unknown",
+                    "res:communities:UNKNOWN:role:member",
+                ]
+            }
+        },
+        "r3": {"attributes": {}},
+    },
+    "users": {
+        "u1": {
+            "allowed_resources": {"r1": {}, "r2": {}},
+            "attributes": {
+                "urn:perun:user:attribute-def:core:displayName": "User One",
+                "urn:perun:user:attribute-def:def:organization": "CESNET",
+                "urn:perun:user:attribute-def:def:preferredMail": "u1@test.com",
+                "urn:perun:user:attribute-def:virt:login-namespace:einfraid-persistent": "u1@einfra",
+            },
+        },
+        "u2": {
+            "allowed_resources": {"r3": {}},
+            "attributes": {
+                "urn:perun:user:attribute-def:def:preferredMail": "u2@test.com",
+                "urn:perun:user:attribute-def:virt:login-namespace:einfraid-persistent": "u2@einfra",
+            },
+        },
+    },
+}
+
+
+def test_dump_from_stream(app):
+    community_id = uuid.uuid4()
+    slug_to_id = {"CUNI": community_id}
+    role_names = frozenset({"curator", "member"})
+
+    stream = io.BytesIO(json.dumps(dump).encode("utf-8"))
+    streamed = PerunDumpData.from_stream(stream, slug_to_id, role_names)
+    in_memory = PerunDumpData(dump, slug_to_id, role_names)
+
+    expected_users = [
+        AAIUser(
+            "u1@einfra",
+            "u1@test.com",
+            "User One",
+            "CESNET",
+            frozenset(
+                {
+                    CommunityRole(community_id, "curator"),
+                    CommunityRole(community_id, "member"),
+                }
+            ),
+        ),
+        AAIUser("u2@einfra", "u2@test.com", None, None, frozenset()),
+    ]
+    # users are parsed from the stream on each iteration, so they can be iterated again
+    assert list(streamed.users()) == expected_users
+    assert list(streamed.users()) == expected_users
+    assert list(in_memory.users()) == expected_users
+
+    assert streamed.aai_community_roles == {
+        CommunityRole(community_id, "curator"),
+        CommunityRole(community_id, "member"),
+    }
@@ -0,0 +1,23 @@
+#
+# Copyright (C) 2024 CESNET z.s.p.o.
+#
+# oarepo-oidc-einfra  is free software; you can redistribute it and/or
+# modify it under the terms of the MIT License; see LICENSE file for more
+# details.
+#
+from oarepo_oidc_einfra.proxies import current_einfra_oidc
+
+
+def test_reload_config(app):
+    vo_id = app.config["EINFRA_REPOSITORY_VO_ID"]
+    assert current_einfra_oidc.repository_vo_id == vo_id
+    try:
+        app.config["EINFRA_REPOSITORY_VO_ID"] = vo_id + 1
+        # the value is read from the configuration only once
+        assert current_einfra_oidc.repository_vo_id == vo_id
+
+        current_einfra_oidc.reload_config()
+        assert current_einfra_oidc.repository_vo_id == vo_id + 1
+    finally:
+        app.config["EINFRA_REPOSITORY_VO_ID"] = vo_id
+        current_einfra_oidc.reload_config()
@@ -7,6 +7,12 @@
 #
 
 import datetime
+import json
+from unittest.mock import patch
+
+import pytest
+
+from oarepo_oidc_einfra.perun import PerunError
 
 
 def test_create_non_existing_group(
@@ -141,3 +147,57 @@ def test_send_invitation(
             .isoformat(),
             redirect_url="https://example.com/invitation-accepted/123456",
         )
+
+
+def test_get_resource_by_capability(
+    smart_record, low_level_perun_api, test_vo_id, test_facility_id
+):
+    with smart_record("test_get_resource_by_capability.yaml"):
+        # default: all the resources of the facility are listed and filtered locally
+        resource = low_level_perun_api.get_resource_by_capability(
+            vo_id=test_vo_id,
+            facility_id=test_facility_id,
+            capability="res:communities:AAA:role:curator",
+        )
+        assert resource["name"] == "Community:AAA"
+
+        # searcher: Perun returns the resources with the capability from all facilities
+        # (the recorded data are synthetic, so check that the searcher gets the right query)
+        session = low_level_perun_api._session
+        with patch.object(session, "post", wraps=session.post) as post:
+            resource = low_level_perun_api.get_resource_by_capability(
+                vo_id=test_vo_id,
+                facility_id=test_facility_id,
+                capability="res:communities:AAA:role:curator",
+                use_searcher=True,
+            )
+        assert resource["name"] == "Community:AAA"
+        assert int(resource["facilityId"]) == test_facility_id
+
+        (searcher_call,) = post.call_args_list
+        assert searcher_call.args[0].endswith("/searcher/getResources")
+        assert json.loads(searcher_call.kwargs["data"]) == {
+            "attributesWithSearchingValues": {
+                "urn:perun:resource:attribute-def:def:capabilities": "res:communities:AAA:role:curator"
+            }
+        }
+
+
+def test_get_missing_resource(
+    smart_record, low_level_perun_api, test_vo_id, test_facility_id
+):
+    with smart_record("test_get_missing_resource.yaml"):
+        # not found is returned as None and is not cached, so Perun is asked again
+        for _ in range(2):
+            assert (
+                low_level_perun_api.get_resource_by_name(
+                    test_vo_id, test_facility_id, "Community:missing"
+                )
+                is None
+            )
+
+        # other errors are still raised
+        with pytest.raises(PerunError):
+            low_level_perun_api.get_resource_by_name(
+                test_vo_id, test_facility_id, "Community:missing"
+            )
@@ -0,0 +1,61 @@
+#
+# Copyright (C) 2024 CESNET z.s.p.o.
+#
+# oarepo-oidc-einfra  is free software; you can redistribute it and/or
+# modify it under the terms of the MIT License; see LICENSE file for more
+# details.
+#
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from oarepo_oidc_einfra.mutex import CacheMutex, _redis_client
+
+
+def test_mutex_wait_budget(app):
+    with CacheMutex("test-mutex"):
+        waiting = CacheMutex(
+            "test-mutex", tries=3, wait_time=0.5, initial_wait_time=0.05
+        )
+        start = time.monotonic()
+        with pytest.raises(ValueError):
+            waiting.__enter__()
+        # the backoff starts small, but the mutex is given up only after
+        # tries * wait_time seconds
+        assert 1.5 <= time.monotonic() - start < 3
+
+    # released, so it can be acquired immediately
+    start = time.monotonic()
+    with CacheMutex("test-mutex", tries=1, wait_time=0.5):
+        pass
+    assert time.monotonic() - start < 0.5
+
+
+def test_mutex_without_redis(app):
+    # the test app uses SimpleCache, so there is no redis client to block on
+    # and the waiter falls back to polling the cache
+    assert _redis_client() is None
+    # a cache whose client is not redis is not used for blocking either
+    not_redis = SimpleNamespace(cache=SimpleNamespace(_write_client=object()))
+    with patch("oarepo_oidc_einfra.mutex.current_cache", not_redis):
+        assert _redis_client() is None
+
+    holder = CacheMutex("test-mutex")
+    holder.__enter__()
+
+    def release():
+        with app.app_context():
+            holder.__exit__(None, None, None)
+
+    timer = threading.Timer(0.3, release)
+    timer.start()
+    try:
+        start = time.monotonic()
+        with CacheMutex("test-mutex", tries=4, wait_time=0.5, initial_wait_time=0.05):
+            # acquired by polling once the holder released it
+            assert 0.25 <= time.monotonic() - start < 2
+    finally:
+        timer.join()
@@ -5,6 +5,8 @@
 # modify it under the terms of the MIT License; see LICENSE file for more
 # details.
 #
+from unittest.mock import patch
+
 from invenio_access.permissions import system_identity
 from invenio_communities import current_communities
 
@@ -27,3 +29,42 @@ def test_sync_community(app, db, location, smart_record, search_clear):
 
     with smart_record("test_initial_sync_community.yaml"):
         synchronize_community_to_perun(community.id)
+
+
+def test_sync_community_skip_unchanged(app, db, location, search_clear):
+    community_data = {
+        "slug": "CUNI",
+        "metadata": {
+            "title": "Charles University",
+            "description": "Charles university members",
+        },
+        "access": {"visibility": "public"},
+    }
+    community = current_communities.service.create(system_identity, community_data)
+    current_communities.service.indexer.refresh()
+
+    with patch(
+        "oarepo_oidc_einfra.tasks.map_community_or_role",
+        return_value=({"id": 1}, {"id": 2}),
+    ) as mapping:
+        # never synchronized - miss
+        synchronize_community_to_perun(community.id, skip_unchanged=True)
+        assert mapping.called
+
+        # nothing has changed since the last synchronization - hit
+        mapping.reset_mock()
+        synchronize_community_to_perun(community.id, skip_unchanged=True)
+        assert not mapping.called
+
+        # not skipped when it is not asked for
+        synchronize_community_to_perun(community.id)
+        assert mapping.called
+
+        # synchronized data have changed - miss
+        mapping.reset_mock()
+        community_data["metadata"]["description"] = "Charles university staff"
+        current_communities.service.update(
+            system_identity, community.id, community_data
+        )
+        synchronize_community_to_perun(community.id, skip_unchanged=True)
+        assert mapping.called
@@ -0,0 +1,77 @@
+#
+# Copyright (C) 2024 CESNET z.s.p.o.
+#
+# oarepo-oidc-einfra  is free software; you can redistribute it and/or
+# modify it under the terms of the MIT License; see LICENSE file for more
+# details.
+#
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from oarepo_oidc_einfra.remote import decode_id_token
+
+
+@pytest.fixture()
+def signing_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture()
+def token_remote(signing_key):
+    return SimpleNamespace(
+        consumer_key="test-client",
+        rsa_key=signing_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        ),
+    )
+
+
+def make_id_token(signing_key, expires_in):
+    return jwt.encode(
+        {"sub": "user1@einfra.cesnet.cz", "aud": "test-client", "exp": expires_in},
+        signing_key,
+        algorithm="RS256",
+    )
+
+
+def test_verified_id_token_is_cached(app, signing_key, token_remote):
+    id_token = make_id_token(signing_key, int(time.time()) + 300)
+
+    with patch("oarepo_oidc_einfra.remote.jwt.decode", wraps=jwt.decode) as decode:
+        payload = decode_id_token(token_remote, id_token)
+        assert payload["sub"] == "user1@einfra.cesnet.cz"
+
+        # modifying the returned payload does not change the cached one
+        payload["sub"] = "changed"
+        assert decode_id_token(token_remote, id_token)["sub"] == (
+            "user1@einfra.cesnet.cz"
+        )
+        assert decode.call_count == 1
+
+
+def test_cached_id_token_expires(app, signing_key, token_remote):
+    id_token = make_id_token(signing_key, int(time.time()) + 2)
+    assert decode_id_token(token_remote, id_token)["sub"] == "user1@einfra.cesnet.cz"
+
+    time.sleep(3)
+
+    # neither the in-process nor the shared cache return the expired token,
+    # so it is verified again and rejected
+    with pytest.raises(jwt.ExpiredSignatureError):
+        decode_id_token(token_remote, id_token)
+
+
+def test_invalid_id_token_is_not_cached(app, signing_key, token_remote):
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    id_token = make_id_token(other_key, int(time.time()) + 300)
+
+    for _ in range(2):
+        with pytest.raises(jwt.InvalidSignatureError):
+            decode_id_token(token_remote, id_token)
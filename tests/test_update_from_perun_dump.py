@@ -6,6 +6,8 @@
 # details.
 #
 from pathlib import Path
+from unittest.mock import patch
+from uuid import UUID
 
 from invenio_access.permissions import system_identity
 from invenio_accounts.models import User, UserIdentity
@@ -19,7 +21,8 @@ from oarepo_oidc_einfra.tasks import update_from_perun_dump
 
 def update_from_file(filename):
     pth = Path(__file__).parent / "dump_data" / filename
-    dump_path, checksum = store_dump(pth.read_bytes())
+    with pth.open("rb") as f:
+        dump_path, checksum = store_dump(f)
     update_from_perun_dump(dump_path, checksum)
 
 
@@ -164,3 +167,70 @@ def test_user_not_found_anymore(app, db, location, search_clear, smart_record):
 
         # check that the user still exists
         User.query.filter_by(username="asdasdasd").one()
+
+
+def test_change_role_in_community(app, db, location, search_clear):
+    community = current_communities.service.create(
+        system_identity,
+        {
+            "slug": "CUNI",
+            "metadata": {
+                "title": "Charles University",
+                "description": "Charles university members",
+            },
+            "access": {"visibility": "public"},
+        },
+    )
+    current_communities.service.indexer.refresh()
+
+    u1 = User(email="u1@test.com", active=True, password="1234")
+    u2 = User(email="u2@test.com", active=True, password="1234")
+    db.session.add(u1)
+    db.session.add(u2)
+    db.session.commit()
+
+    # the roles read from the database carry UUID community ids
+    community_id = UUID(community.id)
+
+    cs = CommunitySupport()
+    cs.set_user_community_membership(u1, {CommunityRole(community_id, "curator")})
+    cs.set_user_community_membership(u2, {CommunityRole(community_id, "curator")})
+    assert cs.get_user_community_membership(u1) == {
+        CommunityRole(community_id, "curator")
+    }
+    (membership_id,) = [
+        m.id for m in Member.model_cls.query.filter_by(user_id=u1.id).all()
+    ]
+
+    # curator -> member in the same community is an update of the membership
+    with (
+        patch.object(
+            CommunitySupport,
+            "_update_user_community_membership",
+            wraps=CommunitySupport._update_user_community_membership,
+        ) as update,
+        patch.object(
+            CommunitySupport,
+            "_add_user_community_membership",
+            wraps=CommunitySupport._add_user_community_membership,
+        ) as add,
+        patch.object(
+            CommunitySupport,
+            "_remove_user_community_membership",
+            wraps=CommunitySupport._remove_user_community_membership,
+        ) as remove,
+    ):
+        cs.set_user_community_membership(u1, {CommunityRole(community_id, "member")})
+    assert update.call_count == 1
+    assert not add.called
+    assert not remove.called
+
+    memberships = list(Member.model_cls.query.filter_by(user_id=u1.id).all())
+    assert len(memberships) == 1
+    # the same membership row, it has not been deleted and added again
+    assert memberships[0].id == membership_id
+    assert memberships[0].role == "member"
+    assert memberships[0].active
+    assert cs.get_user_community_membership(u1) == {
+        CommunityRole(community_id, "member")
+    }